@@ -1,6 +1,6 @@
 # coding: utf-8
 import sys
-from basehandlers import BaseHandler
+from basehandlers import BaseHandler, user_fields
 import tornado.web
 import datetime
 from common import errors
@@ -27,6 +27,7 @@ def send_user_email(handler, sender, recipients, subject, msg=None,
 
 
 class WelcomeHandler(BaseHandler):
+    @user_fields("fullname")
     @tornado.web.authenticated
     def get(self):
         self.render('welcome.html', account_info=self.current_user.fullname)
@@ -68,7 +69,9 @@ class LinkedinLoginCallbackHandler(BaseHandler):
                                   is_valid=True,
                                   signup_source=signup_source)
         self.set_secure_cookie("user_pk", str(user.pk))
-        self.conn.cache.user_info.get_or_add(
+        self.conn.cache.record_active(user.pk)
+        self.conn.cache.start_session(user.pk)
+        self.conn.cache.user_info.add(
                 key_args=user.pk,
                 data=user.get_settings(),
                 ex=3600
@@ -190,7 +193,9 @@ class LoginHandler(BaseHandler):
 
         self.set_secure_cookie("user_pk", str(account.pk))
         self.set_secure_cookie("incorrect", "0")
-        self.conn.cache.user_info.get_or_add(
+        self.conn.cache.record_active(account.pk)
+        self.conn.cache.start_session(account.pk)
+        self.conn.cache.user_info.add(
                 key_args=account.pk,
                 data=account.get_settings(),
                 ex=3600
@@ -200,9 +205,9 @@ class LoginHandler(BaseHandler):
 
 class LogoutHandler(BaseHandler):
     def get(self):
-        user_pk = self.get_secure_cookie("user_pk")
+        user_pk = self.user_pk
         if user_pk:
-            self.conn.cache.user_info.delete(user_pk)
+            self.conn.cache.end_session(user_pk)
         self.clear_cookie("user_pk")
         self.clear_cookie("incorrect")
         self.redirect("/login")
@@ -217,14 +222,8 @@ class AccountInfoHandler(BaseHandler):
     def post(self):
         account = self.get_cur_account()
         account.update_settings(**self.form)
-        account.save(commit=True)
+        account.save(commit=True)    # user_info refreshed after commit
 
-        self.conn.cache.user_info.delete(account.pk)
-        self.conn.cache.user_info.get_or_add(
-                key_args=account.pk,
-                data=account.get_settings(),
-                ex=3600
-        )
         self.render('account_info.html',  info="Personal info successfully saved.",
                     account_info=self.get_current_user())
 
@@ -242,33 +241,7 @@ class WorkExperienceHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self):
         data = json.loads(self.form.data)
-        w_pk = []
-        work_experience = db.WorkExperience.get_work_experience_by_account(self.current_user.pk)
-        for item in work_experience:
-            w_pk.append(item.pk)
-        for item in data:
-            item["account_pk"] = self.current_user.pk
-            work_experience = db.WorkExperience.get_one(pk=item["pk"])
-            if work_experience:
-                if item["pk"] in w_pk:
-                    w_pk.remove(item["pk"])
-                item.pop("pk")
-                work_experience.update(commit=False, **item)
-            else:
-                item.pop("pk")
-                work_experience = db.WorkExperience.create(**item)
-                work_experience.save(commit=False)
-
-        for pk in w_pk:
-            work_experience = db.WorkExperience.get_one(pk=pk)
-            work_experience.delete(commit=False)
-
-        db.cur_session().commit()
-
-        data = []
-        work_experience = db.WorkExperience.get_work_experience_by_account(self.current_user.pk)
-        for item in work_experience:
-            data.append(item.to_dict())
+        data = db.WorkExperience.bulk_sync("account_pk", self.current_user.pk, data)
         self.render('work_experience.html',  work_experience=data)
 
 
@@ -285,31 +258,5 @@ class EducationHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self):
         data = json.loads(self.form.data)
-        w_pk = []
-        education = db.Education.get_education_by_account(self.current_user.pk)
-        for item in education:
-            w_pk.append(item.pk)
-        for item in data:
-            item["account_pk"] = self.current_user.pk
-            education = db.Education.get_one(pk=item["pk"])
-            if education:
-                if item["pk"] in w_pk:
-                    w_pk.remove(item["pk"])
-                item.pop("pk")
-                education.update(commit=False, **item)
-            else:
-                item.pop("pk")
-                education = db.Education.create(**item)
-                education.save(commit=False)
-
-        for pk in w_pk:
-            education = db.Education.get_one(pk=pk)
-            education.delete(commit=False)
-
-        db.cur_session().commit()
-
-        data = []
-        education = db.Education.get_education_by_account(self.current_user.pk)
-        for item in education:
-            data.append(item.to_dict())
+        data = db.Education.bulk_sync("account_pk", self.current_user.pk, data)
         self.render('education.html',  education=data)
\ No newline at end of file
@@ -1,11 +1,13 @@
 # coding: utf-8
 
 import re
+import time
 import types
 import weakref
 import functools
 import threading
 
+from tornado import gen
 from tornado.web import HTTPError
 from tornado.web import RequestHandler
 from tornado.stack_context import StackContext
@@ -15,10 +17,13 @@ from common import errors
 from common.compat import (get_ident, string_types, class_types, iteritems)
 from common.mytypes import MagicDict
 
+from tools import timing
 from tools.log import app_log
 from tools.validate import Invalid
 from tools.rate_limit import rate_limit_ip_global
 
+_UNSET = object()
+
 
 def get_cur_handler():
     """ get current handler saved in ThreadRequestContext,
@@ -31,6 +36,36 @@ def get_cur_handler():
     return cur_handler
 
 
+def get_cur_request_handler():
+    """ get current handler saved in ThreadRequestContext, None outside of a request """
+    handler_ref = ThreadRequestContext.data.get("handler", None)
+    if handler_ref is None:
+        return None
+    return handler_ref()
+
+
+def get_cur_timings():
+    """ get RequestTimings of current handler, None outside of a request """
+    handler = get_cur_request_handler()
+    if handler is None:
+        return None
+    return handler.timings
+
+
+def user_fields(*fields):
+    """ current_user has only fields when it is not resolved yet,
+    use it before tornado.web.authenticated
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapped(self, *args, **kwargs):
+            if "_current_user" not in self.__dict__:
+                self.current_user = self.get_user_fields(fields)
+            return method(self, *args, **kwargs)
+        return wrapped
+    return decorator
+
+
 class ThreadRequestContext(object):
     """A context manager that saves some per-thread state globally.
     Intended for use with Tornado's StackContext.
@@ -75,16 +110,70 @@ class BaseHandler(RequestHandler):
 
     def __init__(self, *args, **kwargs):
         self._form = None     # hold all flat arguments, instance of MagicDict
+        self._inflight = False    # counted in application.inflight
+        self._prepare_time = None     # start of latency metrics
+        self.timings = timing.RequestTimings()    # db, redis, render time
+        self._profile = None      # cProfile.Profile of a sampled request
+        self._page_cache_key = None   # set by page_cache_get on a miss
+        self._user_pk = _UNSET    # user_pk cookie, decoded once per request
+        self._cur_account = None  # get_cur_account without filters
         super(BaseHandler, self).__init__(*args, **kwargs)
 
     def _execute(self, transforms, *args, **kwargs):
         """ inject global data bind to current request """
         global_data = {"handler": weakref.ref(self)}
+        self.application.inflight += 1
+        self._inflight = True
+
+        profiler = self.application.profiler
+        if profiler is not None and profiler.should_profile(self):
+            self._profile = profiler.start()
+
         with StackContext(functools.partial(ThreadRequestContext, **global_data)):
             super(BaseHandler, self)._execute(transforms, *args, **kwargs)
 
+    @property
+    def user_pk(self):
+        """ user_pk cookie, decoded once per request, None if not logged in """
+        if self._user_pk is _UNSET:
+            self._user_pk = self.get_secure_cookie("user_pk")
+        return self._user_pk
+
     def get_current_user(self):
-        return self.conn.cache.user_info.get(key_args=self.get_secure_cookie("user_pk"))
+        user_pk = self.user_pk
+        if not user_pk:
+            return None
+        return self.conn.cache.user_info.get_or_add(
+            key_args=user_pk,
+            data=functools.partial(self.load_user_info, user_pk),
+            ex=3600)
+
+    def get_user_fields(self, fields):
+        """ some fields of user_info read with HMGET, None if not logged in """
+        user_pk = self.user_pk
+        if not user_pk:
+            return None
+        return self.conn.cache.user_info.get_fields(
+            user_pk, fields,
+            data=functools.partial(self.load_user_info, user_pk),
+            ex=3600)
+
+    def load_user_info(self, user_pk):
+        """ settings of an active and valid account, None if not found or
+        logged out, i.e. its session expired or ended
+        """
+        import models as db
+        if not self.conn.cache.has_session(user_pk):
+            return None
+        account = db.Account.get_one(pk=int(user_pk), is_active=True, is_valid=True)
+        if account is None:
+            return None
+        return account.get_settings()
+
+    @property
+    def route(self):
+        """ url pattern of this handler """
+        return self.application.handler_routes.get(self.__class__, self.request.path)
 
     def is_login(self):
         if self.current_user:
@@ -100,28 +189,74 @@ class BaseHandler(RequestHandler):
 
     def get_cur_account(self, **filters):
         """ get account bind to auth.acc_id from database,
-        is_active and is_valid must be True
+        is_active and is_valid must be True, without filters the account
+        is loaded once per request
         :param filters: ext filters for DB search
         :return: current account
         :raise: errors.AccountPermissionError
         """
         import models as db
+        if not filters and self._cur_account is not None:
+            return self._cur_account
         try:
-            return db.Account.get_and_check(pk=int(self.get_secure_cookie("user_pk")),
-                                            is_active=True,
-                                            is_valid=True,
-                                            **filters)
-        except errors.APIError:
+            account = db.Account.get_and_check(pk=int(self.user_pk),
+                                               is_active=True,
+                                               is_valid=True,
+                                               **filters)
+        except (errors.APIError, TypeError):
             raise errors.AccountPermissionError
+        if not filters:
+            self._cur_account = account
+        return account
 
-    @rate_limit_ip_global(limit=None, period=1)     # warning: experimental method
+    @gen.coroutine
     def prepare(self):
+        self._prepare_time = time.time()
+        if self.config.redis_async:
+            # user and rate limit counters over the async client, concurrently
+            yield [self.resolve_current_user(), self.check_rate_limit_async()]
+        else:
+            self.check_rate_limit()
         super(BaseHandler, self).prepare()
 
+    @rate_limit_ip_global(limit=None, period=1)     # warning: experimental method
+    def check_rate_limit(self):
+        pass
+
+    @gen.coroutine
+    def check_rate_limit_async(self):
+        yield self.check_rate_limit.rate_limiter.check_async(self, self.check_rate_limit)
+
+    @gen.coroutine
+    def resolve_current_user(self):
+        """ set current_user with get_or_add_async, get_current_user is not called """
+        user_pk = self.user_pk
+        if not user_pk:
+            self.current_user = None
+            return
+        self.current_user = yield self.conn.cache.user_info.get_or_add_async(
+            key_args=user_pk,
+            data=functools.partial(self.load_user_info, user_pk),
+            ex=3600)
+
+    def request_time(self):
+        """ seconds since prepare, since request start if prepare not called """
+        if self._prepare_time is None:
+            return self.request.request_time()
+        return time.time() - self._prepare_time
+
     def on_finish(self):
         from models import remove_session
         remove_session()
 
+        if self._inflight:
+            self._inflight = False
+            self.application.inflight -= 1
+
+        if self._profile is not None:
+            self.application.profiler.stop(self._profile, self.route, self.request_time())
+            self._profile = None
+
     @property
     def conn(self):
         return self.application.conn
@@ -147,6 +282,29 @@ class BaseHandler(RequestHandler):
                 kwargs[key] = MagicDict(value)
         return super(BaseHandler, self).render(template_name, **kwargs)
 
+    def render_string(self, template_name, **kwargs):
+        start = time.time()
+        try:
+            return super(BaseHandler, self).render_string(template_name, **kwargs)
+        finally:
+            self.timings.add(timing.RENDER, time.time() - start)
+
+    def finish(self, chunk=None):
+        if self._page_cache_key is not None and self.get_status() == 200:
+            if chunk is not None:
+                self.write(chunk)
+                chunk = None
+            # the ETag tornado computes from the buffer is the one of the cached body
+            self.application.page_cache.set(self._page_cache_key, b"".join(self._write_buffer))
+            self._page_cache_key = None
+        self.conn.flush_redis()
+        if self.config.server_timing and not self._headers_written:
+            self.set_header("Server-Timing", self.timings.server_timing(self.request_time()))
+        if self.application.shutting_down and not self._headers_written:
+            # draining, the connection is closed after this response
+            self.set_header("Connection", "close")
+        return super(BaseHandler, self).finish(chunk)
+
     def data_received(self, chunk):
         return super(BaseHandler, self).data_received(chunk)
 
@@ -0,0 +1,226 @@
+# coding: utf-8
+""" Cache engine benchmark, CacheChecker against CacheProxy serializers
+and compressors, and get_many against a loop of get_or_add.
+
+Time hit and miss paths of a user_info sized value, e.g.::
+
+    python bench/cache_bench.py --iterations=20000
+    python bench/cache_bench.py --redis=localhost:6379
+
+The default client keeps values in a dict, so only the engine and
+serializer cost is measured. --redis measures with Redis round trips.
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado.options import OptionParser
+
+from common.mytypes import CacheChecker, MagicDict
+from tools.cache import CacheProxy, Compressor, SERIALIZERS
+
+bench_options = OptionParser()
+bench_options.define("iterations", default=20000, type=int)
+bench_options.define("redis", default=None, help="host:port, default an in-memory dict client")
+bench_options.define("serializers", default="pickle,json,msgpack")
+bench_options.define("compressors", default="zlib,lz4", help="compressors of pickle values")
+bench_options.define("keys", default=50, type=int, help="keys of get_many")
+
+
+class DictClient(object):
+    """ get/set/delete/mget/pipeline/eval of redis.StrictRedis on a dict,
+    round_trips counts requests a Redis server would receive
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        self.round_trips += 1
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def eval(self, script, numkeys, key, token):
+        """ the compare and delete lock release script only """
+        self.round_trips += 1
+        if self.data.get(key) == token:
+            del self.data[key]
+            return 1
+        return 0
+
+    def delete(self, *keys):
+        self.round_trips += 1
+        for key in keys:
+            self.data.pop(key, None)
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return DictPipeline(self)
+
+
+class DictPipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value))
+
+    def execute(self):
+        self.client.round_trips += 1
+        for key, value in self.commands:
+            self.client.data[key] = value
+        self.commands = []
+
+
+def sample_data():
+    return MagicDict({
+        "pk": 12345,
+        "fullname": "Sample User",
+        "email": "sample.user@consult.com",
+        "role": "Talent",
+        "industry": "Both",
+        "phone_num": "5550100",
+        "wechat": "sample_user",
+        "avatar_uri": "https://s3.amazonaws.com/onecareer/avatars/12345.png",
+        "address_line1": "1 Main Street",
+        "address_line2": "",
+        "city": "New York",
+        "state": "NY",
+    })
+
+
+def make_client():
+    if not bench_options.redis:
+        return DictClient()
+
+    import redis
+    host, port = bench_options.redis.split(":")
+    return redis.StrictRedis(host=host, port=int(port), db=15)
+
+
+def timed(func, iterations):
+    start = time.time()
+    for _ in xrange(iterations):
+        func()
+    return (time.time() - start) / iterations * 1000000
+
+
+def bench_checker(client, data, iterations):
+    key = "bench:checker"
+
+    def get_or_add():
+        with CacheChecker(client, key, ex=3600) as cached:
+            cached.data = data
+        return cached.data
+
+    def miss():
+        client.delete(key)
+        get_or_add()
+
+    client.delete(key)
+    get_or_add()
+    hit_us = timed(get_or_add, iterations)
+    miss_us = timed(miss, iterations)
+    return hit_us, miss_us, len(client.get(key))
+
+
+def bench_proxy(client, data, serializer, iterations, compressor=None):
+    proxy = CacheProxy(client, "bench:%s", serializer, compressor=compressor)
+
+    def get_or_add():
+        return proxy.get_or_add(serializer, data, ex=3600)
+
+    def miss():
+        client.delete(proxy.gen_key(serializer))
+        get_or_add()
+
+    client.delete(proxy.gen_key(serializer))
+    get_or_add()
+    hit_us = timed(get_or_add, iterations)
+    miss_us = timed(miss, iterations)
+    return hit_us, miss_us, len(client.get(proxy.gen_key(serializer)))
+
+
+def bench_many(client, data, iterations):
+    """ :return: list of (name, us/op, round trips/op) """
+    proxy = CacheProxy(client, "bench_many:%s")
+    key_args_list = range(bench_options.keys)
+    loader = lambda missing: dict((key_args, data) for key_args in missing)
+    round_trips = lambda: getattr(client, "round_trips", 0)
+
+    def loop():
+        return [proxy.get_or_add(key_args, lambda: data, ex=3600) for key_args in key_args_list]
+
+    def many():
+        return proxy.get_many(key_args_list, loader, ex=3600)
+
+    def delete():
+        client.delete(*[proxy.gen_key(key_args) for key_args in key_args_list])
+
+    results = []
+    for name, func in (("loop get_or_add", loop), ("get_many", many)):
+        for path in ("hit", "miss"):
+            delete()
+            if path == "hit":
+                func()
+                step = func
+            else:
+                step = lambda: (delete(), func())
+            start_trips = round_trips()
+            us = timed(step, iterations)
+            trips = float(round_trips() - start_trips) / iterations
+            if path == "miss":
+                trips -= 1      # delete
+            results.append(("%s %s" % (name, path), us, trips))
+    return results
+
+
+def main():
+    bench_options.parse_command_line()
+    client = make_client()
+    data = sample_data()
+    iterations = bench_options.iterations
+
+    print "%-22s %12s %12s %8s" % ("engine", "hit us/op", "miss us/op", "bytes")
+    print "%-22s %12.2f %12.2f %8d" % (("CacheChecker",) + bench_checker(client, data, iterations))
+    for name in bench_options.serializers.split(","):
+        if name not in SERIALIZERS:
+            raise ValueError("unknown serializer %s" % name)
+        try:
+            result = bench_proxy(client, data, name, iterations)
+        except ImportError as e:
+            print "%-22s skipped, %s" % ("CacheProxy(%s)" % name, e)
+            continue
+        print "%-22s %12.2f %12.2f %8d" % (("CacheProxy(%s)" % name,) + result)
+    for codec in bench_options.compressors.split(","):
+        try:
+            compressor = Compressor(codec, threshold=0)
+        except ImportError as e:
+            print "%-22s skipped, %s" % ("CacheProxy(%s)" % codec, e)
+            continue
+        result = bench_proxy(client, data, "pickle", iterations, compressor)
+        print "%-22s %12.2f %12.2f %8d" % (("CacheProxy(pickle+%s)" % codec,) + result)
+
+    print
+    print "%-22s %12s %12s (%d keys)" % ("multi-key", "us/op", "trips/op", bench_options.keys)
+    for name, us, trips in bench_many(client, data, max(iterations / bench_options.keys, 1)):
+        print "%-22s %12.2f %12.1f" % (name, us, trips)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+# coding: utf-8
+""" In-process load test harness.
+
+Boot web.Application in this process on SQLite and a local Redis stand-in
+(fakeredis, or a redis-server spawned on a free port), drive the main user
+scenarios and print requests per second and p50/p95/p99 latency, e.g.::
+
+    python bench/harness.py --requests=500 --concurrency=16
+    python bench/harness.py --save=bench/baseline.json
+    python bench/harness.py --compare=bench/baseline.json --tolerance=0.2
+
+--compare exits with status 1 when a scenario is slower than the baseline
+by more than tolerance. Client and server share the IOLoop, so numbers are
+comparable between runs of the harness, not with a deployed server.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import shutil
+import tempfile
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.httputil import url_concat
+from tornado.options import OptionParser
+from tornado.testing import bind_unused_port
+
+harness_options = OptionParser()
+harness_options.define("scenarios", default="", help="comma separated scenario names, default all")
+harness_options.define("requests", default=300, type=int, help="iterations per scenario")
+harness_options.define("warmup", default=20, type=int, help="iterations before measuring")
+harness_options.define("concurrency", default=16, type=int)
+harness_options.define("list_items", default="1,10,50", help="list sizes of work/education scenarios")
+harness_options.define("redis", default="auto", help="fake, server or auto")
+harness_options.define("redis_server", default="redis-server", help="redis-server executable")
+harness_options.define("save", default=None, help="save results as a JSON baseline")
+harness_options.define("compare", default=None, help="compare with a JSON baseline")
+harness_options.define("tolerance", default=0.2, type=float,
+                       help="allowed p95 increase and req/s decrease, 0.2 = 20%")
+
+BENCH_EMAIL = "bench@consult.com"
+BENCH_PASSWORD = "bench123"
+# sent as _xsrf cookie and X-XSRFToken header, like a page form would
+BENCH_XSRF = "62656e6368"
+
+BENCH_CONF = """
+debug = False
+db_url = "sqlite:///%(db_file)s"
+metrics_dir = "%(metrics_dir)s"
+redis_options = {"host": "127.0.0.1", "port": %(redis_port)d, "db": 0, "password": None}
+"""
+
+
+def free_port():
+    sock, port = bind_unused_port()
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("redis-server did not start on port %s" % port)
+
+
+def percentile(values, percent):
+    """ nearest-rank percentile of sorted values """
+    if not values:
+        return 0.0
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+class LocalRedis(object):
+    """ fakeredis client, or a throwaway redis-server on a free port """
+
+    def __init__(self, mode):
+        if mode == "auto":
+            try:
+                import fakeredis
+                mode = "fake"
+            except ImportError:
+                mode = "server"
+        self.mode = mode
+        self.port = free_port()
+        self.process = None
+
+    def start(self):
+        if self.mode == "server":
+            self.process = subprocess.Popen(
+                [harness_options.redis_server, "--port", str(self.port),
+                 "--bind", "127.0.0.1", "--save", "", "--appendonly", "no"],
+                stdout=open(os.devnull, "w"))
+            wait_for_port(self.port)
+
+    def install(self, app):
+        if self.mode == "fake":
+            import fakeredis
+            # replace the cached client before anything uses it
+            app.conn.__dict__["redis_sync"] = fakeredis.FakeStrictRedis()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class Harness(object):
+    """ Harness, web.Application and an HTTP server in this process,
+    with a bench account on a fresh SQLite database
+    """
+
+    def __init__(self, redis_mode):
+        self.tmp_dir = tempfile.mkdtemp(prefix="onecareer_bench_")
+        self.redis = LocalRedis(redis_mode)
+        self.app = None
+        self.server = None
+        self.base_url = None
+        self.account_pk = None
+        self.cookie = None
+        self.client = None
+
+    def start(self):
+        self.redis.start()
+
+        conf_file = os.path.join(self.tmp_dir, "bench.conf")
+        with open(conf_file, "w") as f:
+            f.write(BENCH_CONF % {"db_file": os.path.join(self.tmp_dir, "bench.db"),
+                                  "metrics_dir": os.path.join(self.tmp_dir, "metrics"),
+                                  "redis_port": self.redis.port})
+
+        # settings parses sys.argv when imported
+        sys.argv = [sys.argv[0], "--conf=%s" % conf_file, "--warm_up=False", "--logging=warning"]
+        import web
+        import models
+
+        self.app = web.Application()
+        self.redis.install(self.app)
+        models.create_all(self.app.conn.db_engine)
+        account = models.Account.new(email=BENCH_EMAIL, password=BENCH_PASSWORD,
+                                     fullname="bench", role="Talent", is_valid=True)
+        self.account_pk = account.pk
+        models.remove_session()
+
+        sock, port = bind_unused_port()
+        self.server = HTTPServer(self.app)
+        self.server.add_sockets([sock])
+        self.base_url = "http://127.0.0.1:%d" % port
+        self.client = AsyncHTTPClient(max_clients=harness_options.concurrency)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+        if self.app is not None:
+            self.app.conn.close()
+        self.redis.stop()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def request(self, path, method="GET", body=None, auth=True):
+        cookies = ["_xsrf=%s" % BENCH_XSRF]
+        if auth and self.cookie:
+            cookies.append(self.cookie)
+        headers = {"Cookie": "; ".join(cookies)}
+        if method != "GET":
+            headers["X-XSRFToken"] = BENCH_XSRF
+        if body is not None:
+            body = url_concat("", body).lstrip("?")
+        return HTTPRequest(self.base_url + path, method=method, body=body,
+                           headers=headers, follow_redirects=False)
+
+    @gen.coroutine
+    def login(self):
+        resp = yield self.client.fetch(self.login_request(), raise_error=False)
+        if resp.code != 302:
+            raise RuntimeError("bench login failed with HTTP %s" % resp.code)
+        for cookie in resp.headers.get_list("Set-Cookie"):
+            if cookie.startswith("user_pk="):
+                self.cookie = cookie.split(";", 1)[0]
+                return
+        raise RuntimeError("no user_pk cookie in /login response")
+
+    def login_request(self):
+        return self.request("/login", "POST", {"email": BENCH_EMAIL, "password": BENCH_PASSWORD},
+                            auth=False)
+
+    def seed_list(self, model, count):
+        """ replace the list of the bench account with count items
+        :return: list of dicts as posted by the page
+        """
+        import models
+
+        session = models.cur_session()
+        session.query(model).filter_by(account_pk=self.account_pk).delete()
+        items = []
+        for i in range(count):
+            if model is models.WorkExperience:
+                item = model.create(account_pk=self.account_pk, company="company %d" % i,
+                                    title="title %d" % i, start_time="2010-01",
+                                    end_time="2012-01", description="description %d" % i)
+            else:
+                item = model.create(account_pk=self.account_pk, university="university %d" % i,
+                                    degree="degree %d" % i, graduation_year="2012")
+            session.add(item)
+            items.append(item)
+        session.commit()
+
+        data = [item.to_dict() for item in items]
+        models.remove_session()
+        return data
+
+
+class Scenario(object):
+    """ Scenario, requests of one iteration, expected statuses,
+    setup runs before warm up
+    """
+
+    def __init__(self, name, requests_func, statuses, setup=None):
+        self.name = name
+        self.requests_func = requests_func
+        self.statuses = statuses
+        self.setup = setup
+
+
+def make_scenarios(harness):
+    scenarios = []
+    for path in ("/", "/mentors", "/course", "/about", "/login"):
+        scenarios.append(Scenario(
+            "page:%s" % path, lambda path=path: [harness.request(path, auth=False)], (200,)))
+
+    scenarios.extend([
+        Scenario("login", lambda: [harness.login_request()], (302,)),
+        Scenario("welcome", lambda: [harness.request("/welcome")], (200,)),
+        Scenario("account_info:get", lambda: [harness.request("/account/info")], (200,)),
+        Scenario("account_info:post", lambda: [harness.request(
+            "/account/info", "POST", {"fullname": "bench", "phone_num": "5550100",
+                                      "city": "New York", "state": "NY"})], (200,)),
+    ])
+
+    import models
+    for count in [int(c) for c in harness_options.list_items.split(",") if c]:
+        for name, path, model in (("work", "/account/work", models.WorkExperience),
+                                  ("education", "/account/education", models.Education)):
+            items = []
+
+            def setup(model=model, count=count, items=items):
+                items[:] = harness.seed_list(model, count)
+
+            def round_trip(path=path, items=items):
+                return [harness.request(path),
+                        harness.request(path, "POST", {"data": json.dumps(items)})]
+
+            scenarios.append(Scenario("%s:%d" % (name, count), round_trip, (200,), setup))
+
+    return scenarios
+
+
+@gen.coroutine
+def run_scenario(harness, scenario, iterations):
+    """ run iterations with harness_options.concurrency workers
+    :return: (elapsed seconds, sorted iteration latencies, requests, errors)
+    """
+    counter = [iterations]
+    latencies = []
+    stats = {"requests": 0, "errors": 0}
+
+    @gen.coroutine
+    def worker():
+        while counter[0] > 0:
+            counter[0] -= 1
+            start = time.time()
+            for req in scenario.requests_func():
+                resp = yield harness.client.fetch(req, raise_error=False)
+                stats["requests"] += 1
+                if resp.code not in scenario.statuses:
+                    stats["errors"] += 1
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for _ in range(harness_options.concurrency)]
+    raise gen.Return((time.time() - start, sorted(latencies), stats["requests"], stats["errors"]))
+
+
+@gen.coroutine
+def run_all(harness, scenarios):
+    yield harness.login()
+
+    results = {}
+    for scenario in scenarios:
+        if scenario.setup is not None:
+            scenario.setup()
+        if harness_options.warmup:
+            yield run_scenario(harness, scenario, harness_options.warmup)
+
+        elapsed, latencies, requests, errors = yield run_scenario(
+            harness, scenario, harness_options.requests)
+        results[scenario.name] = {
+            "requests": requests,
+            "errors": errors,
+            "rps": round(requests / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+        print_result(scenario.name, results[scenario.name])
+    raise gen.Return(results)
+
+
+def print_result(name, result):
+    print "%-22s %10.1f %10.2f %10.2f %10.2f %8d" % (
+        name, result["rps"], result["p50_ms"], result["p95_ms"], result["p99_ms"], result["errors"])
+
+
+def compare(results, baseline, tolerance):
+    """ :return: list of regression messages """
+    regressions = []
+    for name, old in sorted(baseline["scenarios"].items()):
+        new = results.get(name)
+        if new is None:
+            continue
+        if new["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append("%s: p95 %.2fms, baseline %.2fms" % (name, new["p95_ms"], old["p95_ms"]))
+        if new["rps"] < old["rps"] * (1 - tolerance):
+            regressions.append("%s: %.1f req/s, baseline %.1f req/s" % (name, new["rps"], old["rps"]))
+        if new["errors"] > old["errors"]:
+            regressions.append("%s: %d errors, baseline %d" % (name, new["errors"], old["errors"]))
+    return regressions
+
+
+def main():
+    harness_options.parse_command_line()
+
+    harness = Harness(harness_options.redis)
+    try:
+        harness.start()
+        scenarios = make_scenarios(harness)
+        if harness_options.scenarios:
+            names = harness_options.scenarios.split(",")
+            scenarios = [scenario for scenario in scenarios if scenario.name in names]
+
+        print "%-22s %10s %10s %10s %10s %8s" % ("scenario", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors")
+        results = IOLoop.current().run_sync(lambda: run_all(harness, scenarios))
+    finally:
+        harness.stop()
+
+    if harness_options.save:
+        with open(harness_options.save, "w") as f:
+            json.dump({"meta": {"python": platform.python_version(),
+                                "redis": harness.redis.mode,
+                                "requests": harness_options.requests,
+                                "concurrency": harness_options.concurrency,
+                                "created": int(time.time())},
+                       "scenarios": results}, f, indent=2, sort_keys=True)
+        print "Baseline saved to %s" % harness_options.save
+
+    if harness_options.compare:
+        with open(harness_options.compare) as f:
+            regressions = compare(results, json.load(f), harness_options.tolerance)
+        for message in regressions:
+            print "REGRESSION %s" % message
+        if regressions:
+            sys.exit(1)
+        print "No regression over %d%% tolerance" % (harness_options.tolerance * 100)
+
+
+if __name__ == "__main__":
+    main()
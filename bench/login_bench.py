@@ -0,0 +1,127 @@
+# coding: utf-8
+""" Login throughput benchmark for the prefork mode.
+
+Start web.py once for every --processes value, log in concurrently
+and print requests per second, e.g.::
+
+    python bench/login_bench.py --processes=1,2,4 --requests=2000 --concurrency=64
+
+The login account must exist in the database used by web.py, the test
+account is created by a debug run (python web.py) on the same database.
+"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httputil import url_concat
+from tornado.options import OptionParser
+
+bench_options = OptionParser()
+bench_options.define("processes", default="1,2,4", help="comma separated worker counts")
+bench_options.define("host", default="127.0.0.1")
+bench_options.define("port", default=8890, type=int)
+bench_options.define("requests", default=1000, type=int, help="logins per run")
+bench_options.define("concurrency", default=32, type=int)
+bench_options.define("email", default="test@consult.com")
+bench_options.define("password", default="test123")
+bench_options.define("conf", default=None, help="config file passed to web.py")
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start on %s:%s" % (host, port))
+
+
+def start_server(processes):
+    args = [sys.executable, os.path.join(ROOT, "web.py"),
+            "--debug=False",
+            "--processes=%d" % processes,
+            "--host=%s" % bench_options.host,
+            "--port=%d" % bench_options.port]
+    if bench_options.conf:
+        args.append("--conf=%s" % bench_options.conf)
+
+    server = subprocess.Popen(args, cwd=ROOT)
+    wait_for_port(bench_options.host, bench_options.port)
+    return server
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    server.wait()
+
+
+@gen.coroutine
+def get_xsrf(client, base_url):
+    resp = yield client.fetch(base_url + "/login")
+    for cookie in resp.headers.get_list("Set-Cookie"):
+        if cookie.startswith("_xsrf="):
+            raise gen.Return(cookie.split(";", 1)[0][len("_xsrf="):])
+    raise RuntimeError("no _xsrf cookie in /login response")
+
+
+@gen.coroutine
+def login_worker(client, base_url, xsrf, counter, latencies):
+    body = url_concat("", {"email": bench_options.email,
+                           "password": bench_options.password,
+                           "_xsrf": xsrf}).lstrip("?")
+    while counter[0] > 0:
+        counter[0] -= 1
+        req = HTTPRequest(base_url + "/login", method="POST", body=body,
+                          headers={"Cookie": "_xsrf=%s" % xsrf},
+                          follow_redirects=False)
+        start = time.time()
+        resp = yield client.fetch(req, raise_error=False)
+        if resp.code != 302:
+            raise RuntimeError("login failed with HTTP %s" % resp.code)
+        latencies.append(time.time() - start)
+
+
+@gen.coroutine
+def run_logins():
+    base_url = "http://%s:%d" % (bench_options.host, bench_options.port)
+    client = AsyncHTTPClient(max_clients=bench_options.concurrency)
+    xsrf = yield get_xsrf(client, base_url)
+
+    counter = [bench_options.requests]
+    latencies = []
+    start = time.time()
+    yield [login_worker(client, base_url, xsrf, counter, latencies)
+           for _ in range(bench_options.concurrency)]
+    raise gen.Return((time.time() - start, sorted(latencies)))
+
+
+def main():
+    bench_options.parse_command_line()
+
+    print "%-10s %10s %10s %10s" % ("processes", "req/s", "p50 ms", "p99 ms")
+    for processes in [int(p) for p in bench_options.processes.split(",")]:
+        server = start_server(processes)
+        try:
+            elapsed, latencies = IOLoop.current().run_sync(run_logins)
+        finally:
+            stop_server(server)
+
+        p50 = latencies[int(len(latencies) * 0.50)] * 1000
+        p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+        print "%-10d %10.1f %10.2f %10.2f" % (processes, len(latencies) / elapsed, p50, p99)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# coding: utf-8
+""" Startup time regression check.
+
+Start web.py with --profile-startup, read the time to listen it reports
+and exit with status 1 when it is over the budget::
+
+    python bench/startup_check.py --budget=2.5
+
+"""
+
+import os
+import re
+import sys
+import signal
+import subprocess
+
+from tornado.options import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+check_options = OptionParser()
+check_options.define("budget", default=3.0, type=float, help="seconds to listen")
+check_options.define("port", default=8891, type=int)
+check_options.define("conf", default=None, help="config file passed to web.py")
+check_options.define("verbose", default=False, type=bool, help="print the import tree")
+
+LISTEN_RE = re.compile(r"^Time to listen: ([0-9.]+)ms$")
+
+
+def measure():
+    args = [sys.executable, os.path.join(ROOT, "web.py"),
+            "--profile-startup",
+            "--debug=False",
+            "--warm_up=False",
+            "--port=%d" % check_options.port]
+    if check_options.conf:
+        args.append("--conf=%s" % check_options.conf)
+
+    server = subprocess.Popen(args, cwd=ROOT, stderr=subprocess.PIPE)
+    try:
+        for line in iter(server.stderr.readline, ""):
+            if check_options.verbose:
+                sys.stderr.write(line)
+            match = LISTEN_RE.match(line.strip())
+            if match:
+                return float(match.group(1)) / 1000
+    finally:
+        if server.poll() is None:
+            server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    raise RuntimeError("web.py exited before listening")
+
+
+def main():
+    check_options.parse_command_line()
+
+    elapsed = measure()
+    print "Time to listen: %.3fs, budget %.3fs" % (elapsed, check_options.budget)
+    if elapsed > check_options.budget:
+        print "FAIL: startup time over budget"
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
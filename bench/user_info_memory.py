@@ -0,0 +1,93 @@
+# coding: utf-8
+""" Redis memory of user_info, pickle blob against the hash format.
+
+Write --sample users in both formats to a scratch Redis database, measure
+MEMORY USAGE per key and the growth of used_memory, and extrapolate to
+--users, e.g.::
+
+    python bench/user_info_memory.py --redis=localhost:6379 --db=15 --users=1000000
+
+Needs Redis 4 or newer, the scratch database is flushed.
+"""
+
+import os
+import sys
+import random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado.options import OptionParser
+
+from common.mytypes import MagicDict
+from models.constants import AccountRoles, AccountIndustries, USStates
+from tools.cache import CacheProxy, HashCacheProxy, user_info_codec
+
+report_options = OptionParser()
+report_options.define("redis", default="localhost:6379", help="host:port")
+report_options.define("db", default=15, type=int, help="scratch database, flushed")
+report_options.define("sample", default=10000, type=int, help="users written per format")
+report_options.define("users", default=1000000, type=int, help="users to extrapolate to")
+
+
+def sample_user(pk):
+    with_info = random.random() < 0.5
+    return MagicDict({
+        "pk": pk,
+        "fullname": "User %d" % pk,
+        "email": "user%d@consult.com" % pk,
+        "role": random.choice(AccountRoles.values()),
+        "industry": random.choice(AccountIndustries.values()),
+        "phone_num": "555%07d" % pk if with_info else "",
+        "wechat": "wechat_%d" % pk if with_info else "",
+        "avatar_uri": "",
+        "address_line1": "%d Main Street" % pk if with_info else "",
+        "address_line2": "",
+        "city": "New York" if with_info else "",
+        "state": random.choice(USStates) if with_info else "",
+    })
+
+
+def measure(client, proxy, users):
+    """ :return: (average MEMORY USAGE bytes, used_memory growth per key, encoding) """
+    client.flushdb()
+    before = client.info("memory")["used_memory"]
+    pipe = client.pipeline(transaction=False)
+    for user in users:
+        proxy._pipe_store(pipe, proxy.gen_key(user.pk), proxy._wrap(user, 0.01, {"ex": 3600}),
+                          ex=3600)
+    pipe.execute()
+    after = client.info("memory")["used_memory"]
+
+    pipe = client.pipeline(transaction=False)
+    for user in users:
+        pipe.execute_command("MEMORY USAGE", proxy.gen_key(user.pk))
+    usage = pipe.execute()
+    encoding = client.object("encoding", proxy.gen_key(users[0].pk))
+    return float(sum(usage)) / len(users), float(after - before) / len(users), encoding
+
+
+def main():
+    import redis
+
+    report_options.parse_command_line()
+    host, port = report_options.redis.split(":")
+    client = redis.StrictRedis(host=host, port=int(port), db=report_options.db)
+    users = [sample_user(pk) for pk in range(1, report_options.sample + 1)]
+
+    formats = [
+        ("pickle", CacheProxy(client, "user_info:%s", "pickle", early_refresh=1.0)),
+        ("hash", HashCacheProxy(client, "user_info:h:%s", user_info_codec(), early_refresh=1.0)),
+    ]
+    scale = float(report_options.users) / (1024 * 1024)
+
+    print "%-8s %-10s %14s %14s %16s" % ("format", "encoding", "bytes/key", "used/key",
+                                         "MB at %d" % report_options.users)
+    for name, proxy in formats:
+        usage, used, encoding = measure(client, proxy, users)
+        print "%-8s %-10s %14.1f %14.1f %16.1f" % (name, encoding, usage, used, used * scale)
+    client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
+import logging
+from itertools import chain
 from datetime import datetime, timedelta
 
-from sqlalchemy import func,  MetaData
+from sqlalchemy import func,  MetaData, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker, object_session
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.inspection import inspect
 
 from common import errors
@@ -22,6 +24,7 @@ convention = {
 Metadata = MetaData(naming_convention=convention)
 Base = declarative_base(metadata=Metadata)
 _scope_func = None
+_cache_invalidator = None
 
 
 def scope_func():
@@ -36,8 +39,50 @@ def set_scope_func(func):
     _scope_func = func
 
 
+def set_cache_invalidator(func):
+    """ set the function called after commit with cache keys depending on
+    changed rows, dict of cache proxy name -> set of key_args
+    """
+    global _cache_invalidator
+    _cache_invalidator = func
+
+
+session_factory = sessionmaker()
+
 # warning: it's a scoped session bind to scope_func
-global_session = scoped_session(sessionmaker(), scopefunc=scope_func)
+global_session = scoped_session(session_factory, scopefunc=scope_func)
+
+
+def new_session():
+    """ a session outside of global_session, close it after use """
+    return session_factory()
+
+
+@event.listens_for(session_factory, "after_flush")
+def collect_cache_changes(session, flush_context):
+    """ gather cache keys of flushed rows declared by _cache_deps_ """
+    changes = session.info.setdefault("cache_changes", {})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        for proxy_name, attr in getattr(obj, "_cache_deps_", ()):
+            key_args = getattr(obj, attr)
+            if key_args is not None:
+                changes.setdefault(proxy_name, set()).add(key_args)
+
+
+@event.listens_for(session_factory, "after_commit")
+def apply_cache_changes(session):
+    changes = session.info.pop("cache_changes", None)
+    if changes and _cache_invalidator is not None:
+        # noinspection PyBroadException
+        try:
+            _cache_invalidator(changes)
+        except:
+            logging.exception("cache invalidation failed: %s" % changes)
+
+
+@event.listens_for(session_factory, "after_rollback")
+def discard_cache_changes(session):
+    session.info.pop("cache_changes", None)
 
 
 def bind_engine(engine):
@@ -69,31 +114,51 @@ def remove_session():
     global_session.remove()
 
 
-def _get(cls, ids):
-    multiple = isinstance(ids, (list, tuple, set))
-    if not multiple:
-        ids = [ids]
+# ids per IN clause of get_by_ids, below bind parameter limits of the databases
+GET_CHUNK_SIZE = 500
 
-    results = []
-    for _id in ids:
-        if _id is None:
-            results.append(None)
-            continue
 
-        db_object = cls.query().get(_id)
-        if (db_object is not None) and (db_object not in cls.session()):
-            obj_session = object_session(db_object)
-            if obj_session is not None:
-                obj_session.expunge(db_object)
+def _pk_value(column, value):
+    """ value as the python type of a primary key column, e.g. "1" -> 1 """
+    try:
+        return column.type.python_type(value)
+    except (NotImplementedError, TypeError, ValueError):
+        return value
 
-            # noinspection PyBroadException
-            try:
-                cls.session().add(db_object)
-            except:
-                db_object = cls.session().merge(db_object)
 
-        results.append(db_object)
+def _get(cls, ids, chunk_size=GET_CHUNK_SIZE):
+    """ objects of ids in the current session, objects of the identity map
+    are not queried, the others are loaded with one pk IN query per
+    chunk_size ids
+    :return: list in order of ids, None for missing ids, or an object if
+             ids is a single id
+    """
+    multiple = isinstance(ids, (list, tuple, set))
+    if not multiple:
+        ids = [ids]
+
+    session = cls.session()
+    mapper = inspect(cls)
+    pk_column = mapper.primary_key[0]
+    keys = [None if _id is None else _pk_value(pk_column, _id) for _id in ids]
 
+    found = {}
+    missing = []
+    for key in keys:
+        if key is None or key in found:
+            continue
+        db_object = session.identity_map.get(mapper.identity_key_from_primary_key([key]))
+        if db_object is not None and not inspect(db_object).expired:
+            found[key] = db_object
+        else:
+            found[key] = None
+            missing.append(key)
+
+    for i in range(0, len(missing), chunk_size):
+        for db_object in session.query(cls).filter(pk_column.in_(missing[i:i + chunk_size])):
+            found[mapper.primary_key_from_instance(db_object)[0]] = db_object
+
+    results = [None if key is None else found[key] for key in keys]
     if multiple:
         return results
     else:
@@ -103,6 +168,7 @@ def _get(cls, ids):
 class ModelMixin(object):
     _protect_attrs_ = []
     _to_dict_attrs_ = []
+    _cache_deps_ = []   # (cache proxy name, attribute of key_args) refreshed after commit
     _not_found_error_ = errors.DBNotFoundError
 
     @property
@@ -206,6 +272,83 @@ class ModelMixin(object):
         table = inspect(cls)
         return [c.name for c in table.c]
 
+    @classmethod
+    def bulk_sync(cls, owner_attr, owner_pk, rows, commit=True):
+        """ make the rows of an owner equal to rows in one transaction: one
+        SELECT of the current rows, one INSERT, one executemany UPDATE of the
+        changed rows and one DELETE ... IN. Bulk statements skip ORM events,
+        _cache_deps_ are not refreshed, loaded objects are stale until commit
+        :param owner_attr: owner column, e.g. "account_pk"
+        :param rows: list of dicts of columns, rows with a pk of the owner are
+                     updated, others inserted, other current rows deleted
+        :return: list of MagicDict of the rows as to_dict returns them, in order
+        """
+        session = cls.session()
+        table = cls.__table__
+        columns = set(cls.columns())
+        current = dict((row["pk"], dict(row)) for row in session.execute(
+            table.select().where(table.c[owner_attr] == owner_pk)))
+
+        stored, inserts, updates = [], [], []
+        for row in rows:
+            values = dict((name, value) for name, value in iteritems(row) if name in columns)
+            values[owner_attr] = owner_pk
+            try:
+                pk = int(values.pop("pk", None))
+            except (TypeError, ValueError):
+                pk = None
+            old = current.pop(pk, None)
+            if old is None:
+                inserts.append(values)
+                stored.append(values)
+                continue
+
+            values["pk"] = pk
+            if any(old.get(name) != value for name, value in iteritems(values)):
+                updates.append(values)
+            old.update(values)
+            stored.append(old)
+
+        try:
+            if inserts:
+                cls._bulk_insert(session, inserts)
+            if updates:
+                session.bulk_update_mappings(cls, updates)
+            if current:
+                session.execute(table.delete().where(table.c.pk.in_(current.keys())))
+            if commit:
+                session.commit()
+        except:
+            session.rollback()
+            raise
+
+        fields = cls._to_dict_attrs_ or cls.columns()
+        results = []
+        for values in stored:
+            result = MagicDict((name, values.get(name)) for name in fields
+                               if name not in cls._protect_attrs_)
+            if "pk" in result and "id" not in result:
+                result["id"] = result["pk"]
+            results.append(result)
+        return results
+
+    @classmethod
+    def _bulk_insert(cls, session, inserts):
+        """ insert rows in one statement, pks are set in the dicts of inserts """
+        table = cls.__table__
+        if session.get_bind().dialect.implicit_returning:
+            # multi-row VALUES ... RETURNING, one round trip, rows need the same columns
+            names = set(chain.from_iterable(inserts))
+            for values in inserts:
+                for name in names:
+                    values.setdefault(name, None)
+            result = session.execute(table.insert().values(inserts).returning(table.c.pk))
+            for values, row in zip(inserts, result):
+                values["pk"] = row[0]
+        else:
+            # without RETURNING pks come from one INSERT per row
+            session.bulk_insert_mappings(cls, inserts, return_defaults=True)
+
     def save(self, commit=True):
         self.session().add(self)
         if commit:
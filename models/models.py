@@ -1,9 +1,8 @@
 import sqlalchemy as sa
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload
 from .constants import *
 from .base import *
 import functools
-import bcrypt
 from common.utils import gen_uuid_str
 
 
@@ -14,6 +13,7 @@ class Account(Base, ModelMixin):
     )
     _not_found_error_ = errors.AccountNotFoundError
     _protect_attrs_ = ["password", "verify", "account_info"]
+    _cache_deps_ = [("user_info", "pk")]
     _to_dict_attrs_ = ["pk", "fullname", "email", "joined", "is_active",
                        "is_valid", "role", "industry", "signup_source"]
 
@@ -64,9 +64,11 @@ class Account(Base, ModelMixin):
         return account.verify
 
     def set_password(self, password):
+        import bcrypt
         self.password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
 
     def check_password(self, password):
+        import bcrypt
         return self.password == bcrypt.hashpw(
             password.encode("utf-8"),
             self.password.encode("utf-8")
@@ -91,6 +93,28 @@ class Account(Base, ModelMixin):
             resp.update(self.account_info.to_dict())
         return resp
 
+    @classmethod
+    def get_settings_many(cls, pks, session=None, active_only=False):
+        """ settings of many accounts in one query, bulk loader of user_info
+        :param session: session to query, default current session
+        :param active_only: only accounts both active and valid
+        :return: dict of pk -> settings, keys are pks as given
+        """
+        pks = dict((int(pk), pk) for pk in pks)
+        query = cls.query() if session is None else session.query(cls)
+        query = query.options(joinedload(cls.account_info)).filter(cls.pk.in_(pks.keys()))
+        if active_only:
+            query = query.filter(cls.is_active.is_(True), cls.is_valid.is_(True))
+        return dict((pks[account.pk], account.get_settings()) for account in query.all())
+
+    @classmethod
+    def latest_joined_pks(cls, limit, session=None):
+        """ pks of the latest joined active and valid accounts, latest first """
+        query = cls.query(cls.pk) if session is None else session.query(cls.pk)
+        rows = query.filter(cls.is_active.is_(True), cls.is_valid.is_(True)).order_by(
+            cls.joined.desc()).limit(limit).all()
+        return [row.pk for row in rows]
+
     def update_settings(self, **settings):
         account_cols = Account.columns()
         acc_info_cols = AccountInfo.columns()
@@ -122,6 +146,7 @@ class Verification(Base, VerifyMixin):
 
 class AccountInfo(Base, ModelMixin):
     __tablename__ = "account_info"
+    _cache_deps_ = [("user_info", "account_pk")]
 
     _to_dict_attrs_ = ["phone_num", "wechat", "avatar_uri",
                        "address_line1", "address_line2", "city", "state"]
@@ -23,6 +23,11 @@ define("port", default=8888, help="run on the given port", type=int)
 define("host", default="127.0.0.1", help="run on the given host")
 define("conf", default=None, help="tornado config file")
 define("debug", default=False, help="debug mode")
+define("warm_up", default=None, type=bool,
+       help="open connections and compile templates before listening, "
+            "default on unless debug")
+define("profile_startup", default=False, type=bool,
+       help="print import time tree and time to listen")
 
 
 def parse_config_file(config_file):
@@ -0,0 +1,75 @@
+# coding: utf-8
+""" AutoPipeline against a fakeredis client, run with::
+
+    python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado.ioloop import IOLoop
+
+from tools.auto_pipeline import AutoPipeline
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class AutoPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.client.flushall()
+        self.redis = AutoPipeline(self.client)
+
+    def test_commands(self):
+        self.client.set("user_info:1", "value")
+        self.client.hmset("hash:1", {"fullname": "Sample User", "role": "Talent"})
+
+        self.assertTrue(self.redis.ping())
+        self.assertEqual(self.redis.get("user_info:1"), b"value")
+        self.assertEqual(self.redis.hmget("hash:1", ["fullname", "role", "city"]),
+                         [b"Sample User", b"Talent", None])
+        self.assertEqual(self.redis.hmget("hash:1", "fullname", "role"),
+                         [b"Sample User", b"Talent"])
+        self.assertEqual(self.redis.stats()["round_trips"], 4)
+
+    def test_writes_without_io_loop_are_sent_at_once(self):
+        self.redis.hmset("hash:2", {"pk": "2"})
+        self.redis.expire("hash:2", 60)
+        self.assertEqual(self.client.hgetall("hash:2"), {b"pk": b"2"})
+        self.assertEqual(self.redis.stats()["pending"], 0)
+
+    def test_writes_sent_with_next_read(self):
+        io_loop = IOLoop()
+        io_loop.make_current()
+        try:
+            self.redis.hmset("hash:3", {"pk": "3"})
+            self.redis.expire("hash:3", 60)
+            self.redis.set("user_info:3", "value")
+            self.assertEqual(self.redis.stats()["pending"], 3)
+            self.assertIsNone(self.client.get("user_info:3"))
+
+            self.assertEqual(self.redis.get("user_info:3"), b"value")
+            self.assertEqual(self.redis.hgetall("hash:3"), {b"pk": b"3"})
+            self.assertEqual(self.redis.stats(),
+                             {"commands": 5, "round_trips": 2, "saved": 3, "pending": 0})
+        finally:
+            IOLoop.clear_current()
+            io_loop.close()
+
+    def test_set_nx_returns_reply(self):
+        self.assertTrue(self.redis.set("lock:1", "a", nx=True, px=1000))
+        self.assertIsNone(self.redis.set("lock:1", "b", nx=True, px=1000))
+        self.assertEqual(self.redis.get("lock:1"), b"a")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# coding: utf-8
+""" collapse_stats of tools.profiling, run with::
+
+    python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import pstats
+import cProfile
+import unittest
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tools.profiling import collapse_stats
+
+
+class FakeStats(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+
+A = ("app.py", 1, "a")
+B = ("app.py", 10, "b")
+C = ("app.py", 20, "c")
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+class CollapseStatsTest(unittest.TestCase):
+    def test_time_outside_recorded_callers_is_a_root(self):
+        # b spends 0.3s under a and 0.2s under a frame entered before profiling
+        stats = FakeStats({
+            A: (1, 1, 0.2, 0.5, {}),
+            B: (2, 2, 0.5, 0.5, {A: (1, 1, 0.3, 0.3)}),
+        })
+        folded = collapse_stats(stats, ["route"], defaultdict(int))
+        self.assertEqual(dict(folded), {
+            "route;app.py:1(a)": 200000,
+            "route;app.py:1(a);app.py:10(b)": 300000,
+            "route;app.py:10(b)": 200000,
+        })
+
+    def test_small_calls_are_folded_into_caller(self):
+        stats = FakeStats({
+            A: (1, 1, 1.0, 1.00001, {}),
+            C: (1, 1, 0.00001, 0.00001, {A: (1, 1, 0.00001, 0.00001)}),
+        })
+        folded = collapse_stats(stats, [], defaultdict(int), min_fraction=0.001)
+        self.assertEqual(dict(folded), {"app.py:1(a)": 1000010})
+
+    def test_profile_started_inside_caller(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        for _ in range(20):
+            busy(2000)
+        profile.disable()
+
+        stats = pstats.Stats(profile)
+        total = sum(tt for _, _, tt, _, _ in stats.stats.values())
+        folded = collapse_stats(stats, ["route"], defaultdict(int), min_fraction=0)
+        self.assertAlmostEqual(sum(folded.values()), total * 1000000, delta=total * 10000 + 50)
+        self.assertTrue(any("(busy)" in stack for stack in folded))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# coding: utf-8
+""" ShardedRedis over fakeredis clients, run with::
+
+    python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tools.sharding import ShardedRedis
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ShardedRedisTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = OrderedDict(("node%d" % db, fakeredis.FakeStrictRedis(db=db))
+                                   for db in (1, 2))
+        self.redis = ShardedRedis(self.clients)
+        self.redis.flushdb()
+
+    def test_keyless_commands(self):
+        for i in range(20):
+            self.redis.set("user_info:%d" % i, "value")
+
+        self.assertTrue(self.redis.ping())
+        sizes = self.redis.dbsize()
+        self.assertEqual(list(sizes.keys()), list(self.clients.keys()))
+        self.assertEqual(sum(sizes.values()), 20)
+        self.assertRaises(TypeError, self.redis.get)
+
+    def test_pipeline_rejects_keyless_commands(self):
+        pipe = self.redis.pipeline(transaction=False)
+        self.assertRaises(TypeError, pipe.dbsize)
+        self.assertRaises(TypeError, pipe.ping)
+        self.assertRaises(TypeError, pipe.get)
+        pipe.set("user_info:1", "value")
+        pipe.get("user_info:1")
+        self.assertEqual(pipe.execute(), [True, b"value"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,7 +4,6 @@ import os
 import logging
 from functools import partial
 
-import requests
 from tornado import gen
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 
@@ -51,6 +50,7 @@ class WrappedHTTPResponse(object):
 @gen.coroutine
 def do_async_fetch(method, url, data=None, files=None, headers=None, **kwargs):
     """ requests style http method using tornado AsyncHTTPClient """
+    import requests
     prep = requests.Request(url=url, files=files, data=data,
                             headers=headers, **kwargs).prepare()
     async_req = HTTPRequest(url, method=method, headers=prep.headers, body=prep.body)
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+import threading
+import functools
+
+from tornado.ioloop import IOLoop
+
+from . import timing
+from .log import app_log
+
+
+class AutoPipeline(object):
+    """ AutoPipeline, a redis.StrictRedis wrapper coalescing round trips.
+
+    Writes whose reply callers don't use (buffered_commands) are queued,
+    and sent in one pipeline with the next other command, at the end of
+    the IOLoop tick or on flush (BaseHandler.finish), whichever is first.
+    Commands are sent in the order issued, so a read sees the writes
+    queued before it. Queued writes return None, their errors are logged.
+
+    Other calls keep their usual replies, e.g.::
+
+        redis = AutoPipeline(conn.redis_sync)
+        redis.hmset(key, data)      # queued
+        redis.expire(key, 60)       # queued
+        redis.hgetall(other_key)    # one round trip for the three commands
+
+    """
+
+    buffered_commands = frozenset([
+        "hmset", "hset", "hdel", "expire", "pexpire", "delete",
+        "sadd", "srem", "zadd", "zrem", "zremrangebyrank", "setex", "psetex",
+    ])
+    # not commands, queued writes are sent before them
+    passthrough = frozenset(["pipeline", "pubsub", "lock", "register_script", "transaction",
+                             "scan_iter", "sscan_iter", "hscan_iter", "zscan_iter"])
+
+    def __init__(self, client, max_buffered=100):
+        self.client = client
+        self.max_buffered = max_buffered
+        self._pending = []      # (command, args, kwargs)
+        self._flush_scheduled = False
+        self._lock = threading.RLock()
+
+        self.commands = 0
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        if name == "set":
+            return self._set
+        if name in self.buffered_commands:
+            return functools.partial(self._queue, name)
+        if name in self.passthrough:
+            return self._after_flush(attr)
+        return lambda *args, **kwargs: self._execute(name, args, kwargs)
+
+    def _set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        """ SET NX/XX replies are used (locks), plain SET is queued """
+        if nx or xx:
+            return self._execute("set", (name, value), dict(ex=ex, px=px, nx=nx, xx=xx))
+        return self._queue("set", name, value, ex=ex, px=px)
+
+    def _queue(self, command, *args, **kwargs):
+        io_loop = IOLoop.current(instance=False)
+        with self._lock:
+            self._pending.append((command, args, kwargs))
+            self.commands += 1
+            if io_loop is None or len(self._pending) >= self.max_buffered:
+                # no IOLoop running, e.g. scripts, nothing would flush later
+                self.flush()
+            elif not self._flush_scheduled:
+                self._flush_scheduled = True
+                io_loop.add_callback(self.flush)
+
+    def _execute(self, command, args, kwargs):
+        """ run a command, with the queued writes if any """
+        with self._lock:
+            self.commands += 1
+            self.round_trips += 1
+            pending = self._take_pending() if self._pending else None
+            if pending:
+                # queued writes go first, in the same round trip
+                pipe = self.client.pipeline(transaction=False)
+                for pending_command, pending_args, pending_kwargs in pending:
+                    getattr(pipe, pending_command)(*pending_args, **pending_kwargs)
+                getattr(pipe, command)(*args, **kwargs)
+                results = pipe.execute(raise_on_error=False)
+        if not pending:
+            return getattr(self.client, command)(*args, **kwargs)
+
+        timing.record_saved(len(pending))
+        self._check_results(pending, results[:-1])
+        if isinstance(results[-1], Exception):
+            raise results[-1]
+        return results[-1]
+
+    def _after_flush(self, method):
+        @functools.wraps(method)
+        def wrapped(*args, **kwargs):
+            self.flush()
+            return method(*args, **kwargs)
+        return wrapped
+
+    def _take_pending(self):
+        pending = self._pending
+        self._pending = []
+        self._flush_scheduled = False
+        return pending
+
+    def flush(self):
+        """ send queued writes in one pipeline """
+        with self._lock:
+            if not self._pending:
+                self._flush_scheduled = False
+                return
+            self.round_trips += 1
+            pending = self._take_pending()
+            pipe = self.client.pipeline(transaction=False)
+            for command, args, kwargs in pending:
+                getattr(pipe, command)(*args, **kwargs)
+            # noinspection PyBroadException
+            try:
+                results = pipe.execute(raise_on_error=False)
+            except Exception:
+                app_log.exception("failed to send %d queued Redis commands", len(pending))
+                return
+        timing.record_saved(len(pending) - 1)
+        self._check_results(pending, results)
+
+    @staticmethod
+    def _check_results(pending, results):
+        for (command, args, _), result in zip(pending, results):
+            if isinstance(result, Exception):
+                app_log.error("queued Redis command %s %s failed: %s", command, args[:1], result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "commands": self.commands,
+                "round_trips": self.round_trips,
+                "saved": self.commands - self.round_trips,
+                "pending": len(self._pending),
+            }
@@ -1,15 +1,27 @@
 # coding: utf-8
 
+import time
+from functools import wraps
+
 from concurrent import futures
 from tornado import gen
 from tornado.concurrent import run_on_executor as _run_on_executor
 
-from .log import log_exception
+from .log import log_exception, app_log
+from . import warm_up
 
 
-# add logging
+# add logging, keep pending futures for shutdown
 def run_on_executor(method):
-    return _run_on_executor(log_exception(method))
+    method = _run_on_executor(log_exception(method))
+
+    @wraps(method)
+    def wrapped(self, *args, **kwargs):
+        future = method(self, *args, **kwargs)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+    return wrapped
 
 
 class BackgroundTasks(object):
@@ -17,8 +29,13 @@ class BackgroundTasks(object):
     def __init__(self, config, conn):
         self.config = config
         self.conn = conn
+        self.pending = set()      # futures not done yet
         self.executor._max_workers = self.config.executor_max_workers
 
+    def after_fork(self):
+        """ threads of the parent executor do not survive fork, start a new one """
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.config.executor_max_workers)
+
     # helper methods definition here
     # ...
 
@@ -43,6 +60,13 @@ class BackgroundTasks(object):
     ##################################################
     executor = futures.ThreadPoolExecutor(max_workers=8)
 
+    @run_on_executor
+    def warm_user_info(self, limit, rate):
+        start = time.time()
+        written = warm_up.warm_up_user_info(self.conn, limit, rate)
+        app_log.info("Warm up user_info: %d in %.2fms", written, (time.time() - start) * 1000)
+        return written
+
     @run_on_executor
     def send_mail(self, sender, to_addrs, subject, msg, **kwargs):
         return self.conn.mail_client.send_mail(sender, to_addrs, subject, msg, **kwargs)
@@ -1,37 +1,580 @@
 # coding: utf-8
-from common.mytypes import CacheChecker
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import random
+import hashlib
+import threading
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.concurrent import Future
+
+from common.compat import pickle, string_types, text_type
+from common.mytypes import MagicDict
+from . import timing
+from .log import app_log
+
+_MISSING = object()
+_NEGATIVE = object()    # loaded a negative cache entry
+
+# value of negative cache entries of CacheProxy
+NEGATIVE_MARKER = b"\x00negative"
+
+# first byte of compressed values, no serializer output of 2 bytes or more starts with them
+ZLIB_MARKER = b"\x01"
+LZ4_MARKER = b"\x02"
+
+
+class LocalCache(object):
+    """ LocalCache, in-process LRU cache bounded by entry count and bytes,
+    entries expire after ttl seconds.
+
+    Cached objects are shared by all callers, they must not be modified.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=5):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (expire time, size, data), oldest first
+        self.bytes = 0
+        self.generation = 0     # bumped on every invalidation
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] < time.time():
+                self.bytes -= entry[1]
+                self.expired += 1
+                self.misses += 1
+                return default
+
+            self.entries[key] = entry   # move to the end, most recently used
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, data, size, generation=None):
+        """ cache data, skipped when an invalidation happened since generation
+        was read, the data may be older than the invalidation
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._pop(key)
+            self.entries[key] = (time.time() + self.ttl, size, data)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, entry = self.entries.popitem(last=False)
+                self.bytes -= entry[1]
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+            self.bytes = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(float(self.hits) / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class CacheInvalidator(object):
+    """ CacheInvalidator, keep LocalCache of all workers and nodes coherent.
+
+    Changed keys are published to a Redis channel as "origin timestamp key",
+    a listener thread discards keys changed by other origins and measures
+    the delay between publish and receive.
+
+    Example usage::
+
+        local = LocalCache(ttl=5)
+        invalidator = CacheInvalidator(client, local, "cache_invalidate")
+        invalidator.start()
+
+        invalidator.publish("user_info:1")
+
+    """
+
+    def __init__(self, client, local, channel, retry_delay=1.0):
+        self.client = client
+        self.local = local
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.origin = "%d-%s" % (os.getpid(), uuid.uuid4().hex[:8])
+
+        self.received = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self._pubsub = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        listener = threading.Thread(target=self._listen, name="cache-invalidator")
+        listener.daemon = True
+        listener.start()
+
+    def stop(self):
+        self._running = False
+        if self._pubsub is not None:
+            self._pubsub.close()    # wakes up the listener
+
+    def publish(self, key):
+        self.client.publish(self.channel, "%s %.6f %s" % (self.origin, time.time(), key))
+
+    def publish_many(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        now = time.time()
+        for key in keys:
+            pipe.publish(self.channel, "%s %.6f %s" % (self.origin, now, key))
+        pipe.execute()
+
+    def _listen(self):
+        while self._running:
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                self._pubsub.subscribe(self.channel)
+                self.local.clear()      # messages may be lost while not subscribed
+                for message in self._pubsub.listen():
+                    if not self._running:
+                        break
+                    if message["type"] == "message":
+                        self.handle(message["data"])
+            except Exception:
+                if self._running:
+                    app_log.exception("cache invalidation listener failed, retry in %ss",
+                                      self.retry_delay)
+                    self.local.clear()
+                    time.sleep(self.retry_delay)
+            finally:
+                self._pubsub.close()
+
+    def handle(self, data):
+        origin, published, key = data.split(" ", 2)
+        if origin == self.origin:
+            return      # discarded before publish
+
+        self.local.discard(key)
+        lag = max(time.time() - float(published), 0.0)
+        self.received += 1
+        self.lag_sum += lag
+        self.lag_max = max(self.lag_max, lag)
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "lag_avg_ms": round(self.lag_sum * 1000 / self.received, 2) if self.received else 0.0,
+            "lag_max_ms": round(self.lag_max * 1000, 2),
+        }
+
+
+class PickleSerializer(object):
+    """ any picklable object, reads values written by CacheChecker """
+    name = "pickle"
+
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, raw):
+        return pickle.loads(raw)
+
+
+class JSONSerializer(object):
+    """ JSON, objects are loaded as MagicDict """
+    name = "json"
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(",", ":"))
+
+    def loads(self, raw):
+        return json.loads(raw, object_hook=MagicDict)
+
+
+class MsgpackSerializer(object):
+    """ msgpack compact binary, objects are loaded as MagicDict,
+    requires the msgpack package
+    """
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self._packb = msgpack.packb
+        self._unpackb = msgpack.unpackb
+
+    def dumps(self, data):
+        return self._packb(data, use_bin_type=True)
+
+    def loads(self, raw):
+        return self._unpackb(raw, encoding="utf-8", object_hook=MagicDict)
+
+
+SERIALIZERS = {
+    "pickle": PickleSerializer,
+    "json": JSONSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+
+def get_serializer(serializer):
+    """ serializer instance from a name in SERIALIZERS or an instance """
+    if serializer is None:
+        serializer = "pickle"
+    if isinstance(serializer, string_types):
+        return SERIALIZERS[serializer]()
+    return serializer
+
+
+def _lz4_functions():
+    """ (compress, decompress) of the lz4 package, ImportError if not installed """
+    try:
+        from lz4.block import compress, decompress
+    except ImportError:
+        from lz4 import compress, decompress   # lz4 < 0.10
+    return compress, decompress
+
+
+def decompress(raw):
+    """ value written by any Compressor, raw itself if not compressed """
+    if len(raw) > 1:
+        marker = raw[:1]
+        if marker == ZLIB_MARKER:
+            return zlib.decompress(raw[1:])
+        if marker == LZ4_MARKER:
+            return _lz4_functions()[1](raw[1:])
+    return raw
+
+
+class Compressor(object):
+    """ Compressor, compresses serialized values of threshold bytes or more
+    with zlib or lz4 ("auto" is lz4 if installed), compressed values start
+    with a marker byte, smaller or incompressible values are kept as they
+    are, so both kinds coexist in Redis and any proxy reads them.
+    """
+
+    def __init__(self, codec="auto", threshold=1024, level=6):
+        if codec == "auto":
+            try:
+                _lz4_functions()
+                codec = "lz4"
+            except ImportError:
+                codec = "zlib"
+        if codec == "lz4":
+            self.marker = LZ4_MARKER
+            self._compress = _lz4_functions()[0]
+        elif codec == "zlib":
+            self.marker = ZLIB_MARKER
+            self._compress = lambda raw: zlib.compress(raw, level)
+        else:
+            raise ValueError("unknown compression codec %s" % codec)
+        self.codec = codec
+        self.threshold = threshold
+
+        self.compressed = 0
+        self.skipped = 0        # over threshold but incompressible
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def compress(self, raw):
+        if len(raw) < self.threshold:
+            return raw
+        start = time.time()
+        packed = self.marker + self._compress(raw)
+        self.compress_seconds += time.time() - start
+        if len(packed) >= len(raw):
+            self.skipped += 1
+            return raw
+        self.compressed += 1
+        self.bytes_in += len(raw)
+        self.bytes_out += len(packed)
+        return packed
+
+    def decompress(self, raw):
+        start = time.time()
+        data = decompress(raw)
+        if data is not raw:
+            self.decompressed += 1
+            self.decompress_seconds += time.time() - start
+        return data
+
+    def stats(self):
+        return {
+            "codec": self.codec,
+            "threshold": self.threshold,
+            "compressed": self.compressed,
+            "skipped": self.skipped,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "ratio": round(float(self.bytes_out) / self.bytes_in, 4) if self.bytes_in else 1.0,
+            "compress_ms": round(self.compress_seconds * 1000, 2),
+            "decompressed": self.decompressed,
+            "decompress_ms": round(self.decompress_seconds * 1000, 2),
+        }
+
+
+def get_compressor(compressor):
+    """ None, a Compressor or the codec name of a Compressor with default threshold """
+    if isinstance(compressor, string_types):
+        return Compressor(compressor)
+    return compressor
+
+
+def _tornadoredis_set_kwargs(kwargs):
+    """ redis-py set arguments to tornadoredis ones """
+    names = {"ex": "expire", "px": "pexpire", "nx": "only_if_not_exists", "xx": "only_if_exists"}
+    return dict((names[name], value) for name, value in kwargs.items())
 
 
 class CacheProxy(object):
-    def __init__(self, client, key_template):
+    """ CacheProxy, cached data of one key template.
+
+    get reads the key, get_or_add computes data on a miss and sets it,
+    values are encoded by the serializer of the proxy, undecodable
+    values are misses.
+
+    Stale data is refreshed by one caller holding a Redis lock of the key,
+    the others get the stale data meanwhile. Without stale data,
+    get_or_add_async waits up to lock_wait for the lock holder to set it,
+    get_or_add computes it rather than block its thread (the IOLoop).
+    With early_refresh (XFetch beta, 1.0 is the usual value) data is
+    stored with its compute time and expiry, and recomputed by one caller
+    before it expires, the others keep getting the current data
+    meanwhile. With negative_ttl, data computed as None is cached as not
+    found for negative_ttl seconds. With a compressor, serialized values
+    over its threshold are compressed.
+
+    Example usage::
+
+        user_info = CacheProxy(client, "user_info:%s", serializer="json", early_refresh=1.0)
+        info = user_info.get_or_add(key_args=1, data=account.get_settings, ex=3600)
+
+    """
+
+    release_script = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                      "return redis.call('del', KEYS[1]) end return 0")
+
+    def __init__(self, client, key_template, serializer=None, local=None, invalidator=None,
+                 early_refresh=None, lock_timeout=5.0, lock_wait=0.2,
+                 bulk_loader=None, refresh_ex=None, async_client=None, negative_ttl=None,
+                 compressor=None):
         self.client = client
         self.key_template = key_template
+        self.serializer = get_serializer(serializer)
+        self.compressor = get_compressor(compressor)
+        self.local = local      # LocalCache in front of Redis, optional
+        self.invalidator = invalidator
+        self.early_refresh = early_refresh
+        self.lock_timeout = lock_timeout    # expiry of the Redis lock
+        self.lock_wait = lock_wait      # coroutines wait for the lock holder before computing
+        self.bulk_loader = bulk_loader      # list of key_args -> dict of key_args -> data
+        self.refresh_ex = refresh_ex    # expiry of refreshed keys
+        self.async_client = async_client    # returns a tornadoredis client, optional
+        self.negative_ttl = negative_ttl
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.loads = 0      # data computed on misses
+
+        self._flights = set()   # cache keys computed by a thread of this process
+        self._flights_lock = threading.Lock()
+        self._async_flights = {}    # cache key -> Future, coroutines of the IOLoop
 
     def gen_key(self, key_args):
         return self.key_template % key_args
 
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round(float(self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+            "loads": self.loads,
+            "compression": self.compressor.stats() if self.compressor is not None else None,
+        }
+
     def get_or_add(self, key_args, data=None, **kwargs):
         cache_key = self.gen_key(key_args)
-        with CacheChecker(self.client, cache_key, **kwargs) as cached:
-            if callable(data):
-                data = data()
-            cached.data = data
+        cached_data, stale = self._get(cache_key, check_refresh=True)
+        if cached_data is not _MISSING and not stale:
+            return cached_data
 
-        return cached.data
+        if not callable(data):
+            self._store(cache_key, self._wrap(data, 0, kwargs), **kwargs)
+            return data
+        return self._single_flight(cache_key, data, cached_data, kwargs)
 
     def get(self, key_args, default=None):
-        cache_key = self.gen_key(key_args)
-        with CacheChecker(self.client, cache_key) as cached:
+        cached_data, _ = self._get(self.gen_key(key_args))
+        if cached_data is _MISSING:
             return default
+        return cached_data
+
+    def get_many(self, key_args_list, loader=None, default=None, **kwargs):
+        """ get many keys in one round trip, misses are loaded by loader and set
+        :param key_args_list: list of key_args
+        :param loader: callable, list of missing key_args -> dict of key_args -> data
+        :param kwargs: used by set of loaded data, e.g. ex=3600
+        :return: list of data in key_args_list order, default if not found
+        """
+        cache_keys = [self.gen_key(key_args) for key_args in key_args_list]
+        results = [_MISSING] * len(cache_keys)
+
+        load_indexes = []
+        if self.local is not None:
+            generation = self.local.generation
+            for i, cache_key in enumerate(cache_keys):
+                results[i] = self.local.get(cache_key, _MISSING)
+                if results[i] is _MISSING:
+                    load_indexes.append(i)
+        else:
+            load_indexes = range(len(cache_keys))
+
+        if load_indexes:
+            loaded = self._load_many([cache_keys[i] for i in load_indexes])
+            for i, (cached_data, size) in zip(load_indexes, loaded):
+                # noinspection PyBroadException
+                try:
+                    if cached_data is _NEGATIVE:
+                        self.negative_hits += 1
+                        cached_data = None
+                    elif cached_data is not _MISSING and self.early_refresh:
+                        cached_data = cached_data[0]
+                except Exception:
+                    app_log.warning("undecodable cache value %s", cache_keys[i], exc_info=True)
+                    cached_data = _MISSING
+                results[i] = cached_data
+                if self.local is not None and cached_data is not _MISSING:
+                    self.local.set(cache_keys[i], cached_data, size, generation)
+
+        self.hits += len(results) - len(load_indexes)
+
+        missing = [i for i, cached_data in enumerate(results) if cached_data is _MISSING]
+        self.misses += len(missing)
+        if missing and loader is not None:
+            loaded = loader([key_args_list[i] for i in missing])
+            self.loads += len(missing)
+            items = []
+            for i in missing:
+                data = loaded.get(key_args_list[i])
+                if data is not None:
+                    results[i] = data
+                    items.append((cache_keys[i], self._wrap(data, 0, kwargs)))
+                elif self.negative_ttl:
+                    results[i] = None
+                    items.append((cache_keys[i], _NEGATIVE))
+            if items:
+                self._store_many(items, **kwargs)
+
+        return [default if data is _MISSING else data for data in results]
 
-        return cached.data
+    def set_many(self, items, **kwargs):
+        """ set many keys in one pipeline
+        :param items: dict or list of (key_args, data)
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        items = [(self.gen_key(key_args), data) for key_args, data in items]
+        if not items:
+            return
+        self._store_many([(cache_key, self._wrap(data, 0, kwargs)) for cache_key, data in items],
+                         **kwargs)
+        self._invalidate_many([cache_key for cache_key, _ in items])
+
+    def fill_many(self, items, **kwargs):
+        """ set keys missing in Redis, keys set meanwhile are newer and kept
+        :param items: list of (key_args, data)
+        :return: keys set
+        """
+        items = [(self.gen_key(key_args), data) for key_args, data in items]
+        if not items:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        for cache_key, _ in items:
+            pipe.exists(cache_key)
+        missing = [(cache_key, self._wrap(data, 0, kwargs))
+                   for (cache_key, data), exists in zip(items, pipe.execute()) if not exists]
+        if missing:
+            self._store_many(missing, **kwargs)
+        return len(missing)
+
+    def delete_many(self, key_args_list):
+        cache_keys = [self.gen_key(key_args) for key_args in key_args_list]
+        if not cache_keys:
+            return
+        self.client.delete(*cache_keys)
+        self._invalidate_many(cache_keys)
+
+    def refresh_many(self, key_args_list):
+        """ reload cached keys with bulk_loader in one pipeline, keys not
+        cached stay absent, keys not loaded are deleted,
+        keys are deleted if there is no bulk_loader
+        """
+        if self.bulk_loader is None:
+            return self.delete_many(key_args_list)
+
+        key_args_list = list(key_args_list)
+        loaded = self.bulk_loader(key_args_list)
+        kwargs = {"ex": self.refresh_ex} if self.refresh_ex else {}
+        cache_keys = []
+        pipe = self.client.pipeline(transaction=False)
+        for key_args in key_args_list:
+            cache_key = self.gen_key(key_args)
+            cache_keys.append(cache_key)
+            data = loaded.get(key_args)
+            if data is None:
+                pipe.delete(cache_key)
+            else:
+                self._pipe_store(pipe, cache_key, self._wrap(data, 0, kwargs), xx=True, **kwargs)
+        pipe.execute()
+        self._invalidate_many(cache_keys)
 
     def add(self, key_args, data, **kwargs):
         cache_key = self.gen_key(key_args)
-        cached = CacheChecker(self.client, cache_key, **kwargs)
         if callable(data):
             data = data()
-        cached.set_data(data=data)
+        self._store(cache_key, self._wrap(data, 0, kwargs), **kwargs)
+        self._invalidate(cache_key)
         return data
 
     set = add
@@ -43,11 +586,656 @@ class CacheProxy(object):
             key_args = key_kwargs
         cache_key = self.gen_key(key_args)
         self.client.delete(cache_key)
+        self._invalidate(cache_key)
+
+    # storage, override both to store data another way
+    def _fetch(self, cache_key):
+        """ :return: raw value read from Redis, decoded by _decode """
+        return self.client.get(cache_key)
+
+    def _store(self, cache_key, data, **kwargs):
+        if data is _NEGATIVE:
+            self.client.set(cache_key, NEGATIVE_MARKER, ex=self.negative_ttl)
+        else:
+            self.client.set(cache_key, self._dumps(data), **kwargs)
+
+    def _decode(self, raw):
+        """ :return: (data, size in bytes), data is _MISSING if not found,
+        _NEGATIVE for a negative entry
+        """
+        if raw is None:
+            return _MISSING, 0
+        if raw == NEGATIVE_MARKER:
+            return _NEGATIVE, len(raw)
+        return self._loads(raw), len(raw)
+
+    def _dumps(self, data):
+        raw = self.serializer.dumps(data)
+        if self.compressor is not None:
+            raw = self.compressor.compress(raw)
+        return raw
+
+    def _loads(self, raw):
+        if self.compressor is not None:
+            return self.serializer.loads(self.compressor.decompress(raw))
+        return self.serializer.loads(decompress(raw))
+
+    def _load_many(self, cache_keys):
+        """ :return: list of (data, size) in cache_keys order """
+        results = []
+        for cache_key, raw in zip(cache_keys, self.client.mget(cache_keys)):
+            if raw is None:
+                results.append((_MISSING, 0))
+                continue
+            # noinspection PyBroadException
+            try:
+                results.append(self._decode(raw))
+            except Exception:
+                app_log.warning("undecodable cache value %s", cache_key, exc_info=True)
+                results.append((_MISSING, 0))
+        return results
+
+    def _pipe_store(self, pipe, cache_key, data, **kwargs):
+        """ data _NEGATIVE stores a negative entry for negative_ttl """
+        if data is _NEGATIVE:
+            pipe.set(cache_key, NEGATIVE_MARKER, ex=self.negative_ttl)
+        else:
+            pipe.set(cache_key, self._dumps(data), **kwargs)
+
+    def _store_many(self, items, **kwargs):
+        """ :param items: list of (cache key, data) """
+        pipe = self.client.pipeline(transaction=False)
+        for cache_key, data in items:
+            self._pipe_store(pipe, cache_key, data, **kwargs)
+        pipe.execute()
+
+    # early refresh envelope, [data, compute seconds, expire time]
+    def _wrap(self, data, delta, kwargs):
+        if not self.early_refresh:
+            return data
+        ex = kwargs.get("ex")
+        return [data, delta, time.time() + ex if ex else None]
+
+    def _should_refresh(self, delta, expire_at):
+        if expire_at is None:
+            return False
+        return time.time() - delta * self.early_refresh * math.log(1.0 - random.random()) >= expire_at
+
+    def _get(self, cache_key, check_refresh=False):
+        """ local cache, then _fetch and _decode
+        :return: (data or _MISSING, True if data should be recomputed early)
+        """
+        if self.local is not None:
+            cached_data = self.local.get(cache_key, _MISSING)
+            if cached_data is not _MISSING:
+                self.hits += 1
+                return cached_data, False
+            generation = self.local.generation
+
+        raw = self._fetch(cache_key)    # Redis errors are raised
+        # noinspection PyBroadException
+        try:
+            cached_data, size = self._decode(raw)
+            cached_data, stale = self._unwrap(cached_data, check_refresh)
+        except Exception:
+            # e.g. written by an older format, recomputed
+            app_log.warning("undecodable cache value %s", cache_key, exc_info=True)
+            cached_data, stale = _MISSING, False
+        if cached_data is _MISSING or stale:
+            return cached_data, stale
+
+        if self.local is not None:
+            self.local.set(cache_key, cached_data, size, generation)
+        return cached_data, False
+
+    def _unwrap(self, cached_data, check_refresh):
+        """ count a loaded value and unwrap the early refresh envelope
+        :return: (data, True if data should be recomputed early),
+        data is None for a negative entry
+        """
+        if cached_data is _MISSING:
+            self.misses += 1
+            return _MISSING, False
+        if cached_data is _NEGATIVE:
+            self.negative_hits += 1
+            return None, False
+
+        self.hits += 1
+        if self.early_refresh:
+            cached_data, delta, expire_at = cached_data
+            if check_refresh and self._should_refresh(delta, expire_at):
+                return cached_data, True
+        return cached_data, False
+
+    def _single_flight(self, cache_key, func, stale_data, kwargs):
+        """ one caller refreshes stale data, the others get it meanwhile,
+        a miss without stale data is computed by its caller, the sync path
+        has nothing to serve while another caller computes and never waits
+        """
+        if stale_data is _MISSING:
+            return self._load(cache_key, func, kwargs)
+
+        with self._flights_lock:
+            if cache_key in self._flights:
+                return stale_data
+            self._flights.add(cache_key)
+        try:
+            return self._compute(cache_key, func, stale_data, kwargs)
+        finally:
+            with self._flights_lock:
+                self._flights.discard(cache_key)
+
+    def _compute(self, cache_key, func, stale_data, kwargs):
+        """ refresh data holding the Redis lock of the key,
+        without the lock return stale data
+        """
+        lock_key = cache_key + ":lock"
+        token = uuid.uuid4().hex
+        if not self.client.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)):
+            return stale_data
+        try:
+            return self._load(cache_key, func, kwargs)
+        finally:
+            self.client.eval(self.release_script, 1, lock_key, token)
+
+    def _load(self, cache_key, func, kwargs):
+        """ compute data and store it """
+        start = time.time()
+        data = func()
+        self.loads += 1
+        if data is not None:
+            self._store(cache_key, self._wrap(data, time.time() - start, kwargs), **kwargs)
+        elif self.negative_ttl:
+            self._store(cache_key, _NEGATIVE)
+        return data
+
+    # async variants over tornadoredis, fall back to the sync methods
+    # when there is no async_client
+    @gen.coroutine
+    def get_async(self, key_args, default=None):
+        if self.async_client is None:
+            raise gen.Return(self.get(key_args, default))
+
+        cached_data, _ = yield self._get_async(self.gen_key(key_args))
+        raise gen.Return(default if cached_data is _MISSING else cached_data)
+
+    @gen.coroutine
+    def get_or_add_async(self, key_args, data=None, **kwargs):
+        """ get_or_add, Redis commands don't block the IOLoop, concurrent
+        coroutines missing the same key wait for the first one
+        """
+        if self.async_client is None:
+            raise gen.Return(self.get_or_add(key_args, data, **kwargs))
+
+        cache_key = self.gen_key(key_args)
+        cached_data, stale = yield self._get_async(cache_key, check_refresh=True)
+        if cached_data is not _MISSING and not stale:
+            raise gen.Return(cached_data)
+
+        if not callable(data):
+            yield self._store_async(cache_key, self._wrap(data, 0, kwargs), **kwargs)
+            raise gen.Return(data)
+
+        flight = self._async_flights.get(cache_key)
+        if flight is not None:
+            if cached_data is not _MISSING:
+                raise gen.Return(cached_data)
+            result = yield flight
+            raise gen.Return(result)
+
+        flight = self._async_flights[cache_key] = Future()
+        try:
+            result = yield self._compute_async(cache_key, data, cached_data, kwargs)
+            flight.set_result(result)
+        except Exception:
+            flight.set_exc_info(sys.exc_info())
+            raise
+        finally:
+            self._async_flights.pop(cache_key, None)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def set_async(self, key_args, data, **kwargs):
+        if self.async_client is None:
+            raise gen.Return(self.add(key_args, data, **kwargs))
+
+        cache_key = self.gen_key(key_args)
+        if callable(data):
+            data = data()
+        yield self._store_async(cache_key, self._wrap(data, 0, kwargs), **kwargs)
+        self._invalidate(cache_key)
+        raise gen.Return(data)
+
+    @gen.coroutine
+    def delete_async(self, key_args):
+        if self.async_client is None:
+            raise gen.Return(self.delete(key_args))
+
+        cache_key = self.gen_key(key_args)
+        yield self._call_async("delete", cache_key)
+        self._invalidate(cache_key)
+
+    @gen.coroutine
+    def _call_async(self, command, *args, **kwargs):
+        """ run a tornadoredis command, the pooled connection is released after it """
+        client = self.async_client()
+        start = time.time()
+        try:
+            result = yield gen.Task(getattr(client, command), *args, **kwargs)
+        finally:
+            timing.record(timing.REDIS, time.time() - start)
+            yield gen.Task(client.disconnect)
+        if isinstance(result, Exception):
+            raise result
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _fetch_async(self, cache_key):
+        raw = yield self._call_async("get", cache_key)
+        raise gen.Return(raw)
+
+    @gen.coroutine
+    def _store_async(self, cache_key, data, **kwargs):
+        if data is _NEGATIVE:
+            yield self._call_async("set", cache_key, NEGATIVE_MARKER, expire=self.negative_ttl)
+        else:
+            yield self._call_async("set", cache_key, self._dumps(data),
+                                   **_tornadoredis_set_kwargs(kwargs))
+
+    @gen.coroutine
+    def _get_async(self, cache_key, check_refresh=False):
+        """ _get over _fetch_async """
+        if self.local is not None:
+            cached_data = self.local.get(cache_key, _MISSING)
+            if cached_data is not _MISSING:
+                self.hits += 1
+                raise gen.Return((cached_data, False))
+            generation = self.local.generation
+
+        raw = yield self._fetch_async(cache_key)
+        # noinspection PyBroadException
+        try:
+            cached_data, size = self._decode(raw)
+            cached_data, stale = self._unwrap(cached_data, check_refresh)
+        except Exception:
+            app_log.warning("undecodable cache value %s", cache_key, exc_info=True)
+            cached_data, stale = _MISSING, False
+        if cached_data is _MISSING or stale:
+            raise gen.Return((cached_data, stale))
+
+        if self.local is not None:
+            self.local.set(cache_key, cached_data, size, generation)
+        raise gen.Return((cached_data, False))
+
+    @gen.coroutine
+    def _compute_async(self, cache_key, func, stale_data, kwargs):
+        """ _compute with async Redis commands, func runs on the IOLoop """
+        lock_key = cache_key + ":lock"
+        token = uuid.uuid4().hex
+        locked = yield self._call_async("set", lock_key, token,
+                                        pexpire=int(self.lock_timeout * 1000),
+                                        only_if_not_exists=True)
+        if not locked:
+            if stale_data is not _MISSING:
+                raise gen.Return(stale_data)
+            deadline = time.time() + self.lock_wait
+            while time.time() < deadline:
+                yield gen.sleep(0.01)
+                cached_data, _ = yield self._get_async(cache_key)
+                if cached_data is not _MISSING:
+                    raise gen.Return(cached_data)
+
+        try:
+            start = time.time()
+            data = func()
+            self.loads += 1
+            if data is not None:
+                yield self._store_async(cache_key, self._wrap(data, time.time() - start, kwargs),
+                                        **kwargs)
+            elif self.negative_ttl:
+                yield self._store_async(cache_key, _NEGATIVE)
+        finally:
+            if locked:
+                yield self._call_async("eval", self.release_script, keys=[lock_key], args=[token])
+        raise gen.Return(data)
+
+    def _invalidate(self, cache_key):
+        if self.local is not None:
+            self.local.discard(cache_key)
+        if self.invalidator is not None:
+            self._flush_writes()
+            self.invalidator.publish(cache_key)
+
+    def _invalidate_many(self, cache_keys):
+        if self.local is not None:
+            for cache_key in cache_keys:
+                self.local.discard(cache_key)
+        if self.invalidator is not None:
+            self._flush_writes()
+            self.invalidator.publish_many(cache_keys)
+
+    def _flush_writes(self):
+        """ writes queued by an AutoPipeline client must reach Redis
+        before other workers re-read the invalidated keys
+        """
+        flush = getattr(self.client, "flush", None)
+        if flush is not None:
+            flush()
+
+
+def _encode_text(value):
+    if isinstance(value, text_type):
+        return value.encode("utf-8")
+    return str(value)
+
+
+class StrField(object):
+    """ text, stored as utf-8 """
+    signature = "str"
+
+    def encode(self, value):
+        return _encode_text(value)
+
+    def decode(self, raw):
+        return raw.decode("utf-8")
+
+
+class IntField(object):
+    """ integer, small ones are stored as integers by Redis """
+    signature = "int"
+
+    def encode(self, value):
+        return str(int(value))
+
+    def decode(self, raw):
+        return int(raw)
+
+
+class EnumField(object):
+    """ one of values, stored as its index, other values as "=value" """
+
+    def __init__(self, values):
+        self.values = tuple(values)
+        self.indexes = dict((value, str(i)) for i, value in enumerate(self.values))
+        self.signature = "enum(%s)" % ",".join(self.values)
+
+    def encode(self, value):
+        index = self.indexes.get(value)
+        if index is None:
+            return "=" + _encode_text(value)
+        return index
+
+    def decode(self, raw):
+        if raw.startswith("="):
+            return raw[1:].decode("utf-8")
+        return self.values[int(raw)]
+
+
+class HashCodec(object):
+    """ HashCodec, a dict as the fields of a Redis hash, None values are
+    not stored, fields without a codec are text.
+
+    The _v field holds a checksum of the field codecs, hashes written with
+    other codecs (e.g. reordered enum values) are misses. A negative entry
+    is a hash of _v and _n.
+    """
+    default_field = StrField()
+
+    def __init__(self, fields):
+        self.fields = fields    # name -> field codec
+        self.version = hashlib.sha1(repr(sorted(
+            (name, field.signature) for name, field in fields.items()))).hexdigest()[:8]
+
+    def encode(self, data):
+        mapping = {"_v": self.version}
+        for name, value in data.items():
+            if value is not None:
+                mapping[name] = self.fields.get(name, self.default_field).encode(value)
+        return mapping
+
+    def decode(self, mapping):
+        data = MagicDict((name, None) for name in self.fields)
+        for name, raw in mapping.items():
+            if not name.startswith("_"):
+                data[name] = self.fields.get(name, self.default_field).decode(raw)
+        return data
+
+    def decode_fields(self, names, raws):
+        return MagicDict((name, None if raw is None else
+                          self.fields.get(name, self.default_field).decode(raw))
+                         for name, raw in zip(names, raws))
+
+
+class HashCacheProxy(CacheProxy):
+    """ HashCacheProxy, CacheProxy storing dicts as Redis hashes encoded by
+    a HashCodec, get_fields reads only some fields with HMGET. Fields are
+    not compressed.
+
+    Example usage::
+
+        codec = HashCodec({"pk": IntField(), "role": EnumField(AccountRoles.values())})
+        user_info = HashCacheProxy(client, "user_info:h:%s", codec)
+        user = user_info.get_fields(1, ["fullname"], data=load_user_info, ex=3600)
+
+    """
+
+    set_xx_script = ("if redis.call('exists', KEYS[1]) == 0 then return 0 end "
+                     "redis.call('del', KEYS[1]) "
+                     "redis.call('hmset', KEYS[1], unpack(ARGV, 2)) "
+                     "if tonumber(ARGV[1]) > 0 then redis.call('expire', KEYS[1], ARGV[1]) end "
+                     "return 1")
+
+    def __init__(self, client, key_template, codec, **kwargs):
+        super(HashCacheProxy, self).__init__(client, key_template, **kwargs)
+        self.codec = codec
+
+    def get_fields(self, key_args, fields, data=None, **kwargs):
+        """ get some fields, on a miss the whole data is get_or_add
+        :return: MagicDict of fields, None if not found
+        """
+        cache_key = self.gen_key(key_args)
+        if self.local is not None:
+            cached_data = self.local.get(cache_key, _MISSING)
+            if cached_data is None:
+                self.negative_hits += 1     # negative entry
+                return None
+            if cached_data is not _MISSING:
+                self.hits += 1
+                return MagicDict((name, cached_data.get(name)) for name in fields)
+
+        raws = self.client.hmget(cache_key, ["_v", "_n"] + list(fields))
+        if raws[0] == self.codec.version:
+            if raws[1] is not None:
+                self.negative_hits += 1
+                return None
+            self.hits += 1
+            return self.codec.decode_fields(fields, raws[2:])
+
+        if data is None:
+            return None
+        cached_data = self.get_or_add(key_args, data, **kwargs)
+        if cached_data is None:
+            return None
+        return MagicDict((name, cached_data.get(name)) for name in fields)
+
+    def _encode(self, data):
+        if data is _NEGATIVE:
+            return {"_v": self.codec.version, "_n": "1"}
+        if not self.early_refresh:
+            return self.codec.encode(data)
+        data, delta, expire_at = data
+        mapping = self.codec.encode(data)
+        mapping["_d"] = repr(delta)
+        if expire_at is not None:
+            mapping["_x"] = repr(expire_at)
+        return mapping
+
+    def _decode(self, mapping):
+        """ :return: (data, size), data is _MISSING if not found,
+        _NEGATIVE for a negative entry
+        """
+        if not mapping or mapping.get("_v") != self.codec.version:
+            return _MISSING, 0
+        size = sum(len(name) + len(raw) for name, raw in mapping.items())
+        if "_n" in mapping:
+            return _NEGATIVE, size
+        data = self.codec.decode(mapping)
+        if self.early_refresh:
+            expire_at = mapping.get("_x")
+            data = [data, float(mapping.get("_d", 0)), float(expire_at) if expire_at else None]
+        return data, size
+
+    def _fetch(self, cache_key):
+        return self.client.hgetall(cache_key)
+
+    def _store(self, cache_key, data, **kwargs):
+        pipe = self.client.pipeline(transaction=True)
+        self._pipe_store(pipe, cache_key, data, **kwargs)
+        pipe.execute()
+
+    def _load_many(self, cache_keys):
+        pipe = self.client.pipeline(transaction=False)
+        for cache_key in cache_keys:
+            pipe.hgetall(cache_key)
+        return [self._decode(mapping) for mapping in pipe.execute()]
+
+    def _pipe_store(self, pipe, cache_key, data, ex=None, xx=False, **kwargs):
+        if data is _NEGATIVE:
+            ex = self.negative_ttl
+        mapping = self._encode(data)
+        if xx:
+            args = []
+            for item in mapping.items():
+                args.extend(item)
+            pipe.eval(self.set_xx_script, 1, cache_key, ex or 0, *args)
+            return
+
+        pipe.delete(cache_key)
+        pipe.hmset(cache_key, mapping)
+        if ex:
+            pipe.expire(cache_key, ex)
+
+    @gen.coroutine
+    def _fetch_async(self, cache_key):
+        mapping = yield self._call_async("hgetall", cache_key)
+        raise gen.Return(mapping)
+
+    @gen.coroutine
+    def _store_async(self, cache_key, data, ex=None, **kwargs):
+        if data is _NEGATIVE:
+            ex = self.negative_ttl
+        client = self.async_client()
+        start = time.time()
+        try:
+            pipe = client.pipeline(transactional=True)
+            pipe.delete(cache_key)
+            pipe.hmset(cache_key, self._encode(data))
+            if ex:
+                pipe.expire(cache_key, ex)
+            yield gen.Task(pipe.execute)
+        finally:
+            timing.record(timing.REDIS, time.time() - start)
+            yield gen.Task(client.disconnect)
+
+
+def user_info_codec():
+    from models.constants import AccountRoles, AccountIndustries, USStates
+    return HashCodec({
+        "pk": IntField(),
+        "fullname": StrField(),
+        "email": StrField(),
+        "role": EnumField(AccountRoles.values()),
+        "industry": EnumField(AccountIndustries.values()),
+        "phone_num": StrField(),
+        "wechat": StrField(),
+        "avatar_uri": StrField(),
+        "address_line1": StrField(),
+        "address_line2": StrField(),
+        "city": StrField(),
+        "state": EnumField(USStates),
+    })
+
+
+def load_user_info(pks):
+    """ bulk loader of user_info, queries in its own session,
+    it may be called after commit when the current session can't query,
+    like BaseHandler.load_user_info inactive or invalid accounts are missing
+    """
+    import models as db
+    session = db.new_session()
+    try:
+        return db.Account.get_settings_many(pks, session=session, active_only=True)
+    finally:
+        session.close()
 
 
 class Cache(object):
-    def __init__(self, client):
+    recent_active_key = "recent_active"     # sorted set of account pk by login time
+    recent_active_max = 100000
+    session_key = "session:%s"      # set on login, deleted on logout
+
+    def __init__(self, client, local=None, invalidator=None, async_client=None,
+                 session_timeout=3600):
         self.client = client
+        self.local = local
+        self.invalidator = invalidator
+        self.async_client = async_client
+        self.session_timeout = session_timeout
 
         # add all cache object here
-        self.user_info = CacheProxy(self.client, "user_info:%s")
\ No newline at end of file
+        # hashes, not under user_info:%s where pickled strings were stored (WRONGTYPE)
+        self.user_info = HashCacheProxy(self.client, "user_info:h:%s", user_info_codec(),
+                                        local=local, invalidator=invalidator,
+                                        early_refresh=1.0, bulk_loader=load_user_info,
+                                        refresh_ex=3600, async_client=async_client,
+                                        negative_ttl=60)
+
+    def apply_changes(self, changes):
+        """ refresh keys depending on changed rows
+        :param changes: dict of cache proxy name -> key_args list
+        """
+        for name, key_args_list in changes.items():
+            getattr(self, name).refresh_many(key_args_list)
+
+    def record_active(self, account_pk):
+        """ add an account to the recent_active set on login, trimmed to recent_active_max """
+        self.client.zadd(self.recent_active_key, time.time(), account_pk)
+        self.client.zremrangebyrank(self.recent_active_key, 0, -self.recent_active_max - 1)
+
+    def recent_active(self, limit):
+        """ :return: pks of the most recently logged in accounts, latest first """
+        return self.client.zrevrange(self.recent_active_key, 0, limit - 1)
+
+    def start_session(self, account_pk):
+        """ mark an account logged in for session_timeout seconds, user_info
+        missing in Redis is loaded from the DB meanwhile only
+        """
+        self.client.set(self.session_key % account_pk, 1, ex=self.session_timeout)
+
+    def end_session(self, account_pk):
+        """ log an account out, its cookie is not enough anymore """
+        self.client.delete(self.session_key % account_pk)
+        self.user_info.delete(account_pk)
+
+    def has_session(self, account_pk):
+        return bool(self.client.exists(self.session_key % account_pk))
+
+    def live_sessions(self, pks):
+        """ :return: pks with a session, in order """
+        pipe = self.client.pipeline(transaction=False)
+        for pk in pks:
+            pipe.exists(self.session_key % pk)
+        return [pk for pk, exists in zip(pks, pipe.execute()) if exists]
+
+    def close(self):
+        if self.invalidator is not None:
+            self.invalidator.stop()
+
+    def stats(self):
+        """ hit rates of the local cache and the cache proxies, invalidation lag """
+        stats = {"proxies": {"user_info": self.user_info.stats()}}
+        if self.local is not None:
+            stats["local"] = self.local.stats()
+        if self.invalidator is not None:
+            stats["invalidation"] = self.invalidator.stats()
+        return stats
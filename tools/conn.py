@@ -1,15 +1,28 @@
 # coding: utf-8
 
-import redis
-import tornadoredis
+from collections import OrderedDict
+
 from sqlalchemy import engine_from_config
 
-from common.mytypes import cached_property
+from common.mytypes import cached_property, CachedProperty
 from common.tools.aws import AWSClient
 
 from .mail import EmailClient
 from common.tools.linkedin import LinkedinAPI
-from tools.cache import Cache
+from tools.cache import Cache, LocalCache, CacheInvalidator
+from tools.auto_pipeline import AutoPipeline
+from tools.sharding import ShardedRedis, node_name
+from tools import timing
+
+# heavy modules imported on first use, preload them in the parent so
+# forked workers don't import them again. sqlalchemy is not one of them,
+# models import it at startup
+LAZY_MODULES = ("redis", "tornadoredis", "bcrypt", "requests")
+
+
+def preload_modules():
+    for name in LAZY_MODULES:
+        __import__(name)
 
 
 class Connections(object):
@@ -17,6 +30,30 @@ class Connections(object):
     def __init__(self, config):
         self.config = config
 
+    def close(self):
+        """ close connections opened by this process,
+        they are re-created lazily on next access
+        """
+        if "db_engine" in self.__dict__:
+            self.db_engine.dispose()
+        if "cache" in self.__dict__:
+            self.cache.close()
+        self.flush_redis()
+        if "redis_sync" in self.__dict__:
+            if isinstance(self.redis_sync, ShardedRedis):
+                self.redis_sync.disconnect()
+            else:
+                self.redis_sync.connection_pool.disconnect()
+        self.reset()
+
+    def reset(self):
+        """ forget all cached clients without closing them,
+        call it in forked workers so no socket is shared with the parent
+        """
+        for name in dir(self.__class__):
+            if isinstance(getattr(self.__class__, name), CachedProperty):
+                self.__dict__.pop(name, None)
+
     @cached_property
     def mail_client(self):
         return EmailClient(self.config, prefix="email_")
@@ -30,7 +67,9 @@ class Connections(object):
         # remove unsupported db settings
         if self.config["db_url"].startswith("sqlite:"):
             self.config.pop("db_pool_size", None)
-        return engine_from_config(self.config, prefix="db_")
+        engine = engine_from_config(self.config, prefix="db_")
+        timing.install_db_timer(engine)
+        return engine
 
     @cached_property
     def db_session(self):
@@ -39,16 +78,68 @@ class Connections(object):
 
     @cached_property
     def redis_sync(self):
-        return redis.StrictRedis(**self.config["redis_options"])
-    redis = redis_sync
+        redis_class = timing.timed_redis_class()
+        shards = self.config.get("redis_shards")
+        if not shards:
+            return redis_class(**self.config["redis_options"])
+        return ShardedRedis(OrderedDict((node_name(options), redis_class(**options))
+                                        for options in shards),
+                            replicas=self.config["redis_shard_replicas"])
+
+    @cached_property
+    def redis_pipelined(self):
+        return AutoPipeline(self.redis_sync, self.config.get("redis_auto_pipeline_max", 100))
+
+    @property
+    def redis(self):
+        if self.config.get("redis_auto_pipeline"):
+            return self.redis_pipelined
+        return self.redis_sync
+
+    def flush_redis(self):
+        """ send writes queued by redis_pipelined """
+        if "redis_pipelined" in self.__dict__:
+            self.redis_pipelined.flush()
 
     @cached_property
+    def redis_async_pool(self):
+        import tornadoredis
+        if self.config.get("redis_shards"):
+            raise ValueError("redis_async is not supported with redis_shards")
+        options = self.config["redis_options"]
+        return tornadoredis.ConnectionPool(max_connections=self.config["redis_async_max_connections"],
+                                           wait_for_available=True,
+                                           host=options.get("host", "localhost"),
+                                           port=options.get("port", 6379))
+
+    def redis_async_client(self):
+        """ a tornadoredis client on the shared pool,
+        disconnect it after use to release its connection
+        """
+        import tornadoredis
+        options = self.config["redis_options"]
+        return tornadoredis.Client(connection_pool=self.redis_async_pool,
+                                   selected_db=options.get("db"),
+                                   password=options.get("password"))
+
+    @property
     def redis_async(self):
-        return tornadoredis.Client(**self.config["redis_options"])
+        return self.redis_async_client()
 
     @cached_property
     def cache(self):
-        return Cache(self.redis_sync)
+        async_client = self.redis_async_client if self.config.get("redis_async") else None
+        if not self.config.get("local_cache_ttl"):
+            return Cache(self.redis, async_client=async_client,
+                         session_timeout=self.config["session_timeout"])
+
+        local = LocalCache(max_entries=self.config["local_cache_max_entries"],
+                           max_bytes=self.config["local_cache_max_bytes"],
+                           ttl=self.config["local_cache_ttl"])
+        invalidator = CacheInvalidator(self.redis_sync, local, self.config["local_cache_channel"])
+        invalidator.start()
+        return Cache(self.redis, local, invalidator, async_client,
+                     session_timeout=self.config["session_timeout"])
 
     @cached_property
     def linkedin_client(self):
@@ -0,0 +1,144 @@
+# coding: utf-8
+
+import os
+import glob
+import mmap
+import array
+import ctypes
+from bisect import bisect_left
+
+# latency histogram upper bounds in seconds, +Inf bucket added after them
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+# slots of a route: histogram buckets, latency sum, status classes
+_SUM = len(LATENCY_BUCKETS) + 1
+_STATUS = _SUM + 1
+_ROUTE_SLOTS = _STATUS + len(STATUS_CLASSES)
+
+_OTHER_ROUTE = "<other>"
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class RouteMetrics(object):
+    """ RouteMetrics, request count, status and latency histogram per route.
+
+    Every worker writes to its own preallocated file-backed array of doubles,
+    observe() only increments slots in place. export() sums the files of all
+    workers and formats them as Prometheus text.
+
+    Example usage::
+
+        metrics = RouteMetrics(url_patterns, "/tmp/metrics")
+        metrics.open(worker_id=0)
+
+        metrics.observe(IndexHandler, 200, 0.012)
+        print(metrics.export())
+
+    """
+
+    def __init__(self, url_patterns, store_dir):
+        self.store_dir = store_dir
+        self.routes = []
+        self.route_index = {}     # handler class -> route index
+        for pattern, handler in url_patterns:
+            if handler not in self.route_index:
+                self.route_index[handler] = len(self.routes)
+                self.routes.append(pattern)
+        self.other_index = len(self.routes)
+        self.routes.append(_OTHER_ROUTE)
+
+        self.size = len(self.routes) * _ROUTE_SLOTS
+        self.data = None
+        self._file = None
+        self._mmap = None
+
+    def worker_file(self, worker_id):
+        return os.path.join(self.store_dir, "worker_%d.metrics" % worker_id)
+
+    def clear(self):
+        """ remove files left by a previous run """
+        for file_name in glob.glob(os.path.join(self.store_dir, "*.metrics")):
+            os.remove(file_name)
+
+    def open(self, worker_id):
+        """ map the file of a worker, counts of a restarted worker continue """
+        self.close()
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+        nbytes = self.size * ctypes.sizeof(ctypes.c_double)
+        self._file = open(self.worker_file(worker_id), "a+b")
+        if os.fstat(self._file.fileno()).st_size != nbytes:
+            self._file.truncate(0)
+            self._file.truncate(nbytes)
+        self._mmap = mmap.mmap(self._file.fileno(), nbytes)
+        self.data = (ctypes.c_double * self.size).from_buffer(self._mmap)
+
+    def close(self):
+        if self._mmap is not None:
+            self.data = None
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def observe(self, handler_class, status, seconds):
+        data = self.data
+        if data is None:
+            return
+
+        base = self.route_index.get(handler_class, self.other_index) * _ROUTE_SLOTS
+        data[base + bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        data[base + _SUM] += seconds
+        status_class = status // 100 - 1
+        if 0 <= status_class < len(STATUS_CLASSES):
+            data[base + _STATUS + status_class] += 1
+
+    def collect(self):
+        """ sum the arrays of all workers """
+        total = array.array("d", [0.0]) * self.size
+        nbytes = self.size * total.itemsize
+        for file_name in glob.glob(os.path.join(self.store_dir, "*.metrics")):
+            with open(file_name, "rb") as f:
+                content = f.read()
+            if len(content) != nbytes:
+                continue
+            worker = array.array("d")
+            worker.fromstring(content)
+            for i, value in enumerate(worker):
+                total[i] += value
+        return total
+
+    def export(self):
+        """ format metrics of all workers as Prometheus text """
+        data = self.collect()
+        lines = [
+            "# HELP http_request_duration_seconds Request latency from prepare to finish.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        status_lines = [
+            "# HELP http_requests_total Requests by route and status class.",
+            "# TYPE http_requests_total counter",
+        ]
+
+        bounds = ["%g" % bound for bound in LATENCY_BUCKETS] + ["+Inf"]
+        for index, route in enumerate(self.routes):
+            base = index * _ROUTE_SLOTS
+            label = "route=\"%s\"" % _escape_label(route)
+
+            count = 0
+            for i, bound in enumerate(bounds):
+                count += data[base + i]
+                lines.append("http_request_duration_seconds_bucket{%s,le=\"%s\"} %d" %
+                             (label, bound, count))
+            lines.append("http_request_duration_seconds_sum{%s} %f" % (label, data[base + _SUM]))
+            lines.append("http_request_duration_seconds_count{%s} %d" % (label, count))
+
+            for i, status in enumerate(STATUS_CLASSES):
+                status_lines.append("http_requests_total{%s,status=\"%s\"} %d" %
+                                    (label, status, data[base + _STATUS + i]))
+
+        return "\n".join(lines + status_lines) + "\n"
@@ -0,0 +1,130 @@
+# coding: utf-8
+
+import os
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+
+class PageCache(object):
+    """ PageCache, rendered page bodies and their ETags in memory.
+
+    Entries are dropped, and the template loader reset, when a template
+    under template_root is modified, checked at most every check_interval
+    seconds. A deploy starts with an empty cache.
+
+    Example usage::
+
+        page_cache = PageCache(TEMPLATE_ROOT, loader=settings["template_loader"])
+
+        class IndexHandler(BaseHandler):
+            @page_cache_get(vary=("is_login",))
+            def get(self):
+                self.render("index.html", is_login=self.is_login())
+
+    """
+
+    def __init__(self, template_root, loader=None, max_entries=1000, check_interval=1.0):
+        self.template_root = template_root
+        self.loader = loader
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.entries = OrderedDict()    # key -> (etag, body), oldest first
+        self.version = self.templates_version()
+        self._next_check = time.time() + check_interval
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.resets = 0
+
+    def templates_version(self):
+        """ latest modification time of the templates """
+        version = 0
+        for dir_path, _, file_names in os.walk(self.template_root):
+            for file_name in file_names:
+                version = max(version, os.path.getmtime(os.path.join(dir_path, file_name)))
+        return version
+
+    def check_templates(self):
+        now = time.time()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+
+        version = self.templates_version()
+        if version != self.version:
+            self.version = version
+            self.clear()
+            if self.loader is not None:
+                self.loader.reset()     # compiled templates are cached too
+
+    def get(self, key):
+        """ :return: (etag, body) or None """
+        self.check_templates()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def set(self, key, body):
+        """ :return: strong ETag of body """
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (etag, body)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return etag
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.resets += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(float(self.hits) / lookups, 4) if lookups else 0.0,
+            "not_modified": self.not_modified,
+            "resets": self.resets,
+        }
+
+
+def page_cache_get(vary=()):
+    """ serve GET from application.page_cache, the key is the route, the
+    url arguments and the results of the handler methods named in vary,
+    the rendered body is saved by BaseHandler.finish when status is 200.
+    Pages must not depend on anything else of the request.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapped(self, *args, **kwargs):
+            page_cache = self.application.page_cache
+            if page_cache is None or self.request.method != "GET":
+                return method(self, *args, **kwargs)
+
+            key = (self.route, args) + tuple(getattr(self, name)() for name in vary)
+            entry = page_cache.get(key)
+            if entry is None:
+                self._page_cache_key = key
+                return method(self, *args, **kwargs)
+
+            etag, body = entry
+            self.set_header("Etag", etag)
+            if self.check_etag_header():
+                page_cache.not_modified += 1
+                self.set_status(304)
+            else:
+                self.write(body)
+        return wrapped
+    return decorator
@@ -0,0 +1,257 @@
+# coding: utf-8
+
+import os
+import sys
+import time
+import errno
+import signal
+import random
+import multiprocessing
+from binascii import hexlify
+
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPMessageDelegate
+
+from .log import app_log
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _reseed_random():
+    # forked workers must not share the random state of the parent
+    random.seed(int(hexlify(os.urandom(16)), 16))
+
+
+class Supervisor(object):
+    """ Supervisor, fork worker processes sharing the listening sockets
+    and restart the workers that die.
+
+    SIGTERM/SIGINT are forwarded to the workers and the supervisor exits
+    after them, SIGHUP restarts the workers one by one.
+
+    Example usage::
+
+        sockets = tornado.netutil.bind_sockets(port, host)
+
+        # only worker processes return from start()
+        worker_id = Supervisor(num_processes=4).start()
+
+        server = HTTPServer(app)
+        server.add_sockets(sockets)
+        IOLoop.instance().start()
+
+    """
+
+    def __init__(self, num_processes=0, max_restarts=100, restart_delay=1.0):
+        if num_processes is None or num_processes <= 0:
+            num_processes = cpu_count()
+
+        self.num_processes = num_processes
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self.children = {}      # pid -> worker id
+        self.stopping = False
+        self.rolling = []       # pids waiting for rolling restart
+        self.retiring = None    # pid draining in rolling restart
+
+    def start(self):
+        """ fork workers and supervise them
+        :return: worker id in worker processes, the supervisor process
+            exits when all workers are gone
+        """
+        if IOLoop.initialized():
+            raise RuntimeError("Cannot fork workers after IOLoop created")
+
+        app_log.info("Starting %d worker processes", self.num_processes)
+        for worker_id in range(self.num_processes):
+            if self.spawn(worker_id):
+                return worker_id
+
+        self.install_signals()
+        worker_id = self.supervise()
+        if worker_id is None:
+            app_log.info("All workers exited, supervisor quit")
+            sys.exit(0)
+        return worker_id
+
+    def spawn(self, worker_id):
+        """ fork a worker
+        :return: True in the forked worker, False in the supervisor
+        """
+        pid = os.fork()
+        if pid == 0:
+            self.restore_signals()
+            self.children = {}
+            self.rolling = []
+            self.retiring = None
+            _reseed_random()
+            return True
+
+        self.children[pid] = worker_id
+        app_log.info("Worker %d started, pid %d", worker_id, pid)
+        return False
+
+    def supervise(self):
+        """ wait for dead workers and restart them
+        :return: worker id in a restarted worker, None when all workers exited
+        """
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            abnormal = True
+            if os.WIFSIGNALED(status):
+                app_log.warning("Worker %d (pid %d) killed by signal %d",
+                                worker_id, pid, os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status) != 0:
+                app_log.warning("Worker %d (pid %d) exited with status %d",
+                                worker_id, pid, os.WEXITSTATUS(status))
+            else:
+                app_log.info("Worker %d (pid %d) exited normally", worker_id, pid)
+                abnormal = False
+
+            if self.stopping:
+                continue
+
+            if pid == self.retiring:
+                # rolling restart, replace it and retire the next one
+                if self.spawn(worker_id):
+                    return worker_id
+                self.retire_next()
+                continue
+
+            if abnormal:
+                self.restarts += 1
+                if self.restarts > self.max_restarts:
+                    raise RuntimeError("Too many worker restarts, giving up")
+                time.sleep(self.restart_delay)
+
+            if self.spawn(worker_id):
+                return worker_id
+
+        return None
+
+    def install_signals(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+
+    @staticmethod
+    def restore_signals():
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    def handle_stop(self, signum, frame):
+        """ workers drain their requests on SIGTERM, the supervisor
+        exits when all of them are gone
+        """
+        _ = signum, frame
+        self.stopping = True
+        self.kill_children(signal.SIGTERM)
+
+    def handle_restart(self, signum, frame):
+        """ restart workers one by one, a worker is replaced after
+        it has drained so the others keep serving
+        """
+        _ = signum, frame
+        if self.stopping or self.retiring is not None:
+            return
+        app_log.info("Rolling restart of %d workers", len(self.children))
+        self.rolling = list(self.children)
+        self.retire_next()
+
+    def retire_next(self):
+        self.retiring = None
+        while self.rolling:
+            pid = self.rolling.pop(0)
+            if pid in self.children:
+                self.retiring = pid
+                self.kill(pid, signal.SIGTERM)
+                return
+        app_log.info("Rolling restart finished")
+
+    def kill_children(self, signum=signal.SIGTERM):
+        for pid in list(self.children):
+            self.kill(pid, signum)
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+class DrainingHTTPServer(HTTPServer):
+    """ DrainingHTTPServer, HTTPServer closing keep-alive connections when
+    it drains, idle ones at once, busy ones after their response, so
+    clients reconnect to another worker instead of sending requests to
+    this one until it is killed
+    """
+
+    def initialize(self, *args, **kwargs):
+        super(DrainingHTTPServer, self).initialize(*args, **kwargs)
+        self.draining = False
+        self._idle = set()      # connections waiting for their next request
+
+    def drain(self):
+        """ stop accepting connections and close the idle ones """
+        self.stop()
+        self.draining = True
+        # requests read from now on close their connection after the response
+        self.conn_params.no_keep_alive = True
+        for server_conn in list(self._idle):
+            server_conn.close()
+        self._idle.clear()
+
+    def start_request(self, server_conn, request_conn):
+        delegate = super(DrainingHTTPServer, self).start_request(server_conn, request_conn)
+        if self.draining:
+            # kept alive by a request read before drain
+            IOLoop.current().add_callback(server_conn.close)
+        else:
+            self._idle.add(server_conn)
+        return _BusyDelegate(self, server_conn, delegate)
+
+    def on_close(self, server_conn):
+        self._idle.discard(server_conn)
+        super(DrainingHTTPServer, self).on_close(server_conn)
+
+
+class _BusyDelegate(HTTPMessageDelegate):
+    """ takes its connection out of the idle ones once request headers arrive """
+
+    def __init__(self, server, server_conn, delegate):
+        self.server = server
+        self.server_conn = server_conn
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.server._idle.discard(self.server_conn)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        return self.delegate.on_connection_close()
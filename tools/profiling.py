@@ -0,0 +1,172 @@
+# coding: utf-8
+""" Sampling request profiler and pstats to collapsed stacks converter.
+
+Merge profiles into a flamegraph-ready collapsed-stack file::
+
+    python tools/profiling.py --output=profile.folded /tmp/onecareer_profiles/*.prof
+    flamegraph.pl profile.folded > profile.svg
+
+"""
+
+import os
+import re
+import sys
+import time
+import pstats
+import cProfile
+from collections import defaultdict
+
+_SLUG_RE = re.compile(r"[^0-9a-zA-Z]+")
+
+
+def route_slug(route):
+    return _SLUG_RE.sub("_", route).strip("_") or "index"
+
+
+class RequestProfiler(object):
+    """ RequestProfiler, cProfile 1 in sample_rate requests, or requests
+    sending trigger_header with the admin token, and save them as pstats
+    files named <route>.<ms>ms.<timestamp>.<pid>.prof
+
+    warning: cProfile profiles the thread, callbacks of other requests
+    running on the IOLoop while a profiled request waits are included,
+    only one request is profiled at a time
+    """
+    trigger_header = "X-Profile"
+
+    def __init__(self, profile_dir, sample_rate=0, admin_token=None):
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.admin_token = admin_token
+        self.counter = 0
+        self.active = None
+
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+    def should_profile(self, handler):
+        if self.active is not None:
+            return False
+
+        if self.admin_token and handler.request.headers.get(self.trigger_header) == self.admin_token:
+            return True
+
+        if self.sample_rate:
+            self.counter += 1
+            if self.counter >= self.sample_rate:
+                self.counter = 0
+                return True
+        return False
+
+    def start(self):
+        self.active = cProfile.Profile()
+        self.active.enable()
+        return self.active
+
+    def stop(self, profile, route, elapsed):
+        """ stop and save a profile
+        :return: saved file name
+        """
+        profile.disable()
+        if profile is self.active:
+            self.active = None
+
+        file_name = os.path.join(self.profile_dir, "%s.%dms.%d.%d.prof" % (
+            route_slug(route), elapsed * 1000, time.time(), os.getpid()))
+        profile.dump_stats(file_name)
+        return file_name
+
+
+def _frame_name(func):
+    file_name, line, name = func
+    if file_name == "~":
+        return name     # built-in
+    return "%s:%d(%s)" % (os.path.basename(file_name), line, name)
+
+
+def collapse_stats(stats, prefix, folded, max_depth=64, min_fraction=0.0001):
+    """ convert pstats to collapsed stacks, time of a function is split
+    between its callers in proportion to the time spent through each call
+    edge, time not spent through a recorded caller (frames entered before
+    profiling started) is a root of its own
+    :param stats: pstats.Stats
+    :param prefix: list of frames prepended to every stack
+    :param folded: dict of stack -> microseconds, updated in place
+    :param min_fraction: calls under this fraction of the total time are
+                         not walked, their time is added to their caller
+    """
+    callees = defaultdict(dict)
+    roots = []
+    total = 0.0
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        total += tt
+        root_time = ct - sum(edge[3] for edge in callers.values())
+        if root_time > 0:
+            roots.append((func, root_time))
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]     # cumulative time through this edge
+    min_time = total * min_fraction
+
+    def walk(func, stack, time_spent):
+        """ :param time_spent: cumulative time of func under stack """
+        ct = stats.stats[func][3]
+        stack = stack + [_frame_name(func)]
+        fraction = time_spent / ct
+        own_time = stats.stats[func][2] * fraction
+        if len(stack) >= max_depth:
+            own_time = time_spent   # truncated, callees are folded into func
+        else:
+            for callee, edge_time in callees[func].items():
+                callee_time = min(edge_time * fraction, stats.stats[callee][3])
+                if callee_time <= 0 or _frame_name(callee) in stack:
+                    continue    # skip recursion
+                if callee_time < min_time:
+                    own_time += callee_time
+                else:
+                    walk(callee, stack, callee_time)
+
+        micros = int(round(own_time * 1000000))
+        if micros > 0:
+            folded[";".join(stack)] += micros
+
+    for root, root_time in roots:
+        if root_time >= min_time:
+            walk(root, list(prefix), min(root_time, stats.stats[root][3]))
+    return folded
+
+
+def merge_profiles(file_names, min_fraction=0.0001):
+    """ merge pstats files into collapsed stacks, the first frame is the route
+    :return: dict of stack -> microseconds
+    """
+    folded = defaultdict(int)
+    for file_name in file_names:
+        route = os.path.basename(file_name).split(".", 1)[0]
+        collapse_stats(pstats.Stats(file_name), [route], folded, min_fraction=min_fraction)
+    return folded
+
+
+def main():
+    from tornado.options import OptionParser
+
+    parser = OptionParser()
+    parser.define("output", default=None, help="collapsed stack file, default stdout")
+    parser.define("min_fraction", default=0.0001, type=float,
+                  help="calls under this fraction of a profile are folded into their caller")
+    file_names = parser.parse_command_line()
+    if not file_names:
+        parser.print_help()
+        sys.exit(1)
+
+    folded = merge_profiles(file_names, parser.min_fraction)
+    output = open(parser.output, "w") if parser.output else sys.stdout
+    try:
+        for stack, micros in sorted(folded.items()):
+            output.write("%s %d\n" % (stack, micros))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,11 @@
 
 import time
 from functools import wraps, partial
+
+from tornado import gen
+
 from common import errors
+from tools import timing
 
 
 class RateLimiter(object):
@@ -37,6 +41,7 @@ class RateLimiter(object):
 
             return view(handler, *args, **kwargs)
 
+        wrapped.rate_limiter = self
         return wrapped
 
     def refresh_count(self, handler, view):
@@ -56,6 +61,36 @@ class RateLimiter(object):
         handler.set_header("X-RateLimit-Limit", self.limit)
         handler.set_header("X-RateLimit-Remaining", self.remaining)
 
+    @gen.coroutine
+    def check_async(self, handler, view):
+        """ count and check the limit over handler.conn.redis_async,
+        counts are kept per call as coroutines of requests interleave
+        """
+        if self.limit is None:
+            return
+
+        key = self.key_func(handler, view)
+        reset = int(time.time()) + self.period
+
+        client = handler.conn.redis_async
+        start = time.time()
+        try:
+            pipe = client.pipeline()
+            pipe.incr(key)
+            pipe.expireat(key, reset)
+            results = yield gen.Task(pipe.execute)
+        finally:
+            timing.record(timing.REDIS, time.time() - start)
+            yield gen.Task(client.disconnect)
+        current = results[0]
+
+        if self.send_x_headers:
+            handler.set_header("X-RateLimit-Reset", reset)
+            handler.set_header("X-RateLimit-Limit", self.limit)
+            handler.set_header("X-RateLimit-Remaining", self.limit - current)
+        if current > self.limit:
+            raise self.error
+
 
 # decorators
 rate_limit_ip_global = partial(
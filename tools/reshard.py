@@ -0,0 +1,135 @@
+# coding: utf-8
+""" Move Redis keys to their node after redis_shards changed.
+
+Scan every node of the old list, and move keys whose node on the new
+ring is another one with DUMP/RESTORE (TTL kept), then delete them from
+the old node, e.g. adding a third node::
+
+    python tools/reshard.py --old=10.0.0.1:6379/2,10.0.0.2:6379/2 \\
+        --new=10.0.0.1:6379/2,10.0.0.2:6379/2,10.0.0.3:6379/2 --dry_run
+
+Run it after deploying the new list: keys not moved yet are misses
+meanwhile, a key written on its new node first is not overwritten.
+"""
+
+import os
+import sys
+import time
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado.options import OptionParser
+
+from tools.sharding import HashRing, node_name
+
+reshard_options = OptionParser()
+reshard_options.define("old", default="", help="nodes before, host:port/db,...")
+reshard_options.define("new", default="", help="nodes after, host:port/db,...")
+reshard_options.define("password", default=None)
+reshard_options.define("replicas", default=160, type=int, help="redis_shard_replicas")
+reshard_options.define("match", default=None, help="only keys matching this pattern")
+reshard_options.define("batch", default=500, type=int, help="keys per pipeline")
+reshard_options.define("rate", default=5000, type=int, help="keys moved per second at most")
+reshard_options.define("dry_run", default=False, type=bool, help="count keys to move only")
+
+
+def parse_nodes(value):
+    """ :return: OrderedDict of node name -> redis options """
+    nodes = OrderedDict()
+    for name in value.split(","):
+        host, _, port_db = name.strip().partition(":")
+        port, _, db = port_db.partition("/")
+        options = {"host": host, "port": int(port or 6379), "db": int(db or 0),
+                   "password": reshard_options.password}
+        nodes[node_name(options)] = options
+    return nodes
+
+
+def move_batch(source, clients, moves):
+    """ DUMP/PTTL on source, RESTORE on targets, DEL moved keys on source
+    :param moves: list of (key, target node name)
+    :return: keys moved
+    """
+    import redis
+
+    pipe = source.pipeline(transaction=False)
+    for key, _ in moves:
+        pipe.dump(key)
+        pipe.pttl(key)
+    dumps = pipe.execute()
+
+    targets = OrderedDict()
+    for i, (key, node) in enumerate(moves):
+        value, pttl = dumps[2 * i], dumps[2 * i + 1]
+        if value is None:
+            continue    # expired or deleted meanwhile
+        targets.setdefault(node, []).append((key, value, max(pttl, 0)))
+
+    moved = []
+    for node, items in targets.items():
+        pipe = clients[node].pipeline(transaction=False)
+        for key, value, pttl in items:
+            pipe.restore(key, pttl, value)
+        for (key, _, _), result in zip(items, pipe.execute(raise_on_error=False)):
+            if isinstance(result, redis.ResponseError) and "BUSYKEY" in str(result):
+                pass    # written on the new node already, it is newer
+            elif isinstance(result, Exception):
+                print >> sys.stderr, "failed to move %s to %s: %s" % (key, node, result)
+                continue
+            moved.append(key)
+
+    if moved:
+        source.delete(*moved)
+    return len(moved)
+
+
+def reshard(old_nodes, new_nodes):
+    import redis
+
+    clients = {}
+    for nodes in (old_nodes, new_nodes):
+        for name, options in nodes.items():
+            clients[name] = redis.StrictRedis(**options)
+    ring = HashRing(new_nodes.keys(), reshard_options.replicas)
+
+    total_moved = 0
+    for name in old_nodes:
+        source = clients[name]
+        scanned = to_move = moved = 0
+        batch = []
+        start = time.time()
+        for key in source.scan_iter(match=reshard_options.match, count=reshard_options.batch):
+            scanned += 1
+            node = ring.get_node(key)
+            if node == name:
+                continue
+            to_move += 1
+            batch.append((key, node))
+            if len(batch) >= reshard_options.batch:
+                if not reshard_options.dry_run:
+                    moved += move_batch(source, clients, batch)
+                    # throttle to --rate keys per second
+                    time.sleep(max(0.0, float(moved) / reshard_options.rate - (time.time() - start)))
+                batch = []
+        if batch and not reshard_options.dry_run:
+            moved += move_batch(source, clients, batch)
+
+        print "%-24s scanned %d, to move %d (%.1f%%), moved %d" % (
+            name, scanned, to_move, 100.0 * to_move / scanned if scanned else 0.0, moved)
+        total_moved += moved
+    return total_moved
+
+
+def main():
+    reshard_options.parse_command_line()
+    if not reshard_options.old or not reshard_options.new:
+        reshard_options.print_help()
+        sys.exit(1)
+    moved = reshard(parse_nodes(reshard_options.old), parse_nodes(reshard_options.new))
+    print "moved %d keys" % moved
+
+
+if __name__ == "__main__":
+    main()
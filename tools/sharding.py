@@ -0,0 +1,221 @@
+# coding: utf-8
+
+import struct
+import bisect
+import hashlib
+import itertools
+from collections import OrderedDict
+
+from common.compat import text_type
+
+
+def hash_tag(key):
+    """ part of key hashed, the text inside the first {...} if not empty,
+    like Redis Cluster, e.g. "oauth2:{42}:tokens" and "user:{42}" share "42"
+    """
+    if isinstance(key, text_type):
+        key = key.encode("utf-8")
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def node_name(options):
+    """ ring name of a node from its redis options, host:port/db """
+    return "%s:%s/%s" % (options.get("host", "localhost"), options.get("port", 6379),
+                         options.get("db", 0))
+
+
+class HashRing(object):
+    """ HashRing, consistent hashing of keys to nodes with virtual nodes.
+
+    Each node has `replicas` points on a 32-bit ring, a key goes to the
+    node of the first point at or after its hash, so adding a node moves
+    about 1/N of the keys. Points depend on node names only, renaming a
+    node (e.g. a new host) moves its keys.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        points = []
+        for node in nodes:
+            for i in range(replicas // 4):
+                digest = hashlib.md5("%s-%d" % (node, i)).digest()
+                points.extend((point, node) for point in struct.unpack("<4I", digest))
+        points.sort()
+        self.nodes = list(nodes)
+        self._points = [point for point, _ in points]
+        self._point_nodes = [node for _, node in points]
+
+    @staticmethod
+    def key_hash(key):
+        return struct.unpack("<I", hashlib.md5(hash_tag(key)).digest()[:4])[0]
+
+    def get_node(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect_left(self._points, self.key_hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._point_nodes[index]
+
+
+class ShardedRedis(object):
+    """ ShardedRedis, redis.StrictRedis interface over several nodes.
+
+    Single key commands go to the node of their key on a HashRing, DEL
+    and MGET are split by node, EVAL keys must share a node (hash tags).
+    Pub/sub goes to the first node. Commands without a key (PING, INFO,
+    DBSIZE, ...) go to every node, other commands called without a key
+    raise TypeError. Pipelines are split by node too, one round trip per
+    node, MULTI/EXEC is per node.
+
+    Example usage::
+
+        redis = ShardedRedis(OrderedDict((node_name(options), StrictRedis(**options))
+                                         for options in config["redis_shards"]))
+        redis.hmset("oauth2:client_user:{%s}" % acc_id, data)
+
+    """
+    # sent to every node, True if all replies are
+    broadcast_commands = frozenset(["ping", "flushdb", "flushall", "script_flush"])
+    # sent to every node, OrderedDict of node name -> reply
+    keyless_commands = frozenset(["info", "dbsize", "time", "lastsave", "keys", "randomkey",
+                                  "config_get", "config_set", "config_resetstat",
+                                  "client_list", "slowlog_get", "script_exists", "script_load"])
+    primary_commands = frozenset(["publish", "pubsub"])
+
+    def __init__(self, clients, replicas=160):
+        self.clients = clients      # node name -> StrictRedis, OrderedDict
+        self.ring = HashRing(clients.keys(), replicas)
+        self.primary = clients[self.ring.nodes[0]]
+
+    def node_for(self, key):
+        return self.clients[self.ring.get_node(key)]
+
+    def __getattr__(self, name):
+        attr = getattr(self.primary, name)
+        if name.startswith("_") or not callable(attr) or name in self.primary_commands:
+            return attr
+        if name in self.broadcast_commands:
+            return lambda *args, **kwargs: all([getattr(client, name)(*args, **kwargs)
+                                                for client in self.clients.values()])
+        if name in self.keyless_commands:
+            return lambda *args, **kwargs: OrderedDict(
+                (node, getattr(client, name)(*args, **kwargs))
+                for node, client in self.clients.items())
+
+        def command(*args, **kwargs):
+            if not args:
+                raise TypeError("%s needs a key to be routed to a node" % name)
+            return getattr(self.node_for(args[0]), name)(*args, **kwargs)
+        return command
+
+    def group_keys(self, keys):
+        """ :return: OrderedDict of node name -> list of (index, key) """
+        groups = OrderedDict()
+        for index, key in enumerate(keys):
+            groups.setdefault(self.ring.get_node(key), []).append((index, key))
+        return groups
+
+    def delete(self, *names):
+        return sum(self.clients[node].delete(*[key for _, key in keys])
+                   for node, keys in self.group_keys(names).items())
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        values = [None] * len(keys)
+        for node, indexed_keys in self.group_keys(keys).items():
+            node_values = self.clients[node].mget([key for _, key in indexed_keys])
+            for (index, _), value in zip(indexed_keys, node_values):
+                values[index] = value
+        return values
+
+    def script_node(self, numkeys, keys_and_args):
+        """ node name of the keys of a script, the first node without keys """
+        keys = keys_and_args[:numkeys]
+        if not keys:
+            return self.ring.nodes[0]
+        nodes = set(self.ring.get_node(key) for key in keys)
+        if len(nodes) > 1:
+            raise ValueError("keys of a script must be on one node, use hash tags: %s" % (keys,))
+        return nodes.pop()
+
+    def eval(self, script, numkeys, *keys_and_args):
+        client = self.clients[self.script_node(numkeys, keys_and_args)]
+        return client.eval(script, numkeys, *keys_and_args)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        client = self.clients[self.script_node(numkeys, keys_and_args)]
+        return client.evalsha(sha, numkeys, *keys_and_args)
+
+    def scan_iter(self, match=None, count=None):
+        return itertools.chain(*[client.scan_iter(match, count)
+                                 for client in self.clients.values()])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def disconnect(self):
+        for client in self.clients.values():
+            client.connection_pool.disconnect()
+
+
+class ShardedPipeline(object):
+    """ pipeline of ShardedRedis, a pipeline per node, results in command order """
+
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self._pipes = OrderedDict()     # node name -> pipeline
+        self._counts = {}       # node name -> commands queued
+        self._commands = []     # list of [(node name, index in node pipeline)], per command
+
+    def _queue(self, node, name, *args, **kwargs):
+        pipe = self._pipes.get(node)
+        if pipe is None:
+            pipe = self._pipes[node] = self.sharded.clients[node].pipeline(self.transaction)
+        getattr(pipe, name)(*args, **kwargs)
+        index = self._counts.get(node, 0)
+        self._counts[node] = index + 1
+        return node, index
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if name in ShardedRedis.primary_commands:
+                node = self.sharded.ring.nodes[0]
+            elif name in ("eval", "evalsha"):
+                node = self.sharded.script_node(args[1], args[2:])
+            elif (name in ShardedRedis.broadcast_commands or name in ShardedRedis.keyless_commands
+                  or not args):
+                raise TypeError("%s has no key, call it on ShardedRedis, not in a pipeline" % name)
+            else:
+                node = self.sharded.ring.get_node(args[0])
+            self._commands.append([self._queue(node, name, *args, **kwargs)])
+            return self
+        return command
+
+    def delete(self, *names):
+        self._commands.append([self._queue(node, "delete", *[key for _, key in keys])
+                               for node, keys in self.sharded.group_keys(names).items()])
+        return self
+
+    def execute(self, raise_on_error=True):
+        results = dict((node, pipe.execute(raise_on_error)) for node, pipe in self._pipes.items())
+        self._pipes = OrderedDict()
+        self._counts = {}
+        commands, self._commands = self._commands, []
+
+        values = []
+        for parts in commands:
+            part_values = [results[node][index] for node, index in parts]
+            if len(part_values) == 1:
+                values.append(part_values[0])
+            else:
+                values.append(sum(part_values))     # DEL split by node
+        return values
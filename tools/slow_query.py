@@ -0,0 +1,176 @@
+# coding: utf-8
+
+import os
+import sys
+import json
+import time
+import logging
+import logging.handlers
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_ROOT = os.path.join(ROOT, "models")
+
+
+def params_shape(parameters, executemany=False):
+    """ describe parameters by name and type, values are never recorded """
+    if executemany:
+        if not parameters:
+            return "0 x ()"
+        return "%d x %s" % (len(parameters), params_shape(parameters[0]))
+    if isinstance(parameters, dict):
+        return "(%s)" % ", ".join("%s:%s" % (key, type(value).__name__)
+                                  for key, value in sorted(parameters.items()))
+    if isinstance(parameters, (list, tuple)):
+        return "(%s)" % ", ".join(type(value).__name__ for value in parameters)
+    return type(parameters).__name__
+
+
+def find_call_site(frame):
+    """ find the model method and the application code calling it
+    :return: (model method, call site), "file:line function" or None
+    """
+    model_method = call_site = None
+    while frame is not None:
+        file_name = os.path.abspath(frame.f_code.co_filename)
+        if file_name.startswith(ROOT) and not file_name.startswith(os.path.join(ROOT, "tools")):
+            site = "%s:%d %s" % (os.path.relpath(file_name, ROOT),
+                                 frame.f_lineno, frame.f_code.co_name)
+            if file_name.startswith(MODELS_ROOT):
+                if model_method is None:
+                    model_method = site
+            else:
+                call_site = site
+                break
+        frame = frame.f_back
+    return model_method, call_site
+
+
+class StatementStats(object):
+    __slots__ = ("count", "total", "max", "rows", "routes", "call_sites")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.routes = Counter()
+        self.call_sites = Counter()
+
+    def add(self, elapsed, rows, route, call_site):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.rows += max(rows, 0)
+        self.routes[route] += 1
+        self.call_sites[call_site] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+            "avg_ms": round(self.total * 1000 / self.count, 2) if self.count else 0,
+            "rows": self.rows,
+            "routes": dict(self.routes),
+            "call_sites": dict(self.call_sites),
+        }
+
+
+class SlowQueryLog(object):
+    """ SlowQueryLog, record statements slower than threshold with the
+    route, handler class and model method issuing them, and aggregate
+    them by statement template.
+
+    Example usage::
+
+        slow_log = SlowQueryLog(threshold=0.1, handler_func=get_cur_request_handler,
+                                log_file="/var/log/onecareer/slow_query.log")
+        slow_log.install(engine)
+
+        print(slow_log.top(10))
+
+    """
+
+    def __init__(self, threshold, handler_func=None, log_file=None,
+                 max_bytes=10 * 1024 * 1024, backup_count=5, max_statements=1000):
+        self.threshold = threshold
+        self.handler_func = handler_func
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_statements = max_statements
+        self.stats = {}     # statement -> StatementStats
+
+        self.logger = logging.getLogger("slow_query")
+        self.logger.setLevel(logging.INFO)
+        self._file_handler = None
+        self.open_log(log_file)
+
+    def open_log(self, log_file):
+        """ log to a rotating file, to the root logger if log_file is None,
+        prefork workers must use a file each
+        """
+        if self._file_handler is not None:
+            self.logger.removeHandler(self._file_handler)
+            self._file_handler.close()
+            self._file_handler = None
+
+        self.logger.propagate = log_file is None
+        if log_file:
+            self._file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=self.max_bytes, backupCount=self.backup_count)
+            self._file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger.addHandler(self._file_handler)
+
+    def install(self, engine):
+        from sqlalchemy import event
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("slow_query_start", []).append(time.time())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.time() - conn.info["slow_query_start"].pop()
+            if elapsed >= self.threshold:
+                self.record(statement, parameters, executemany, elapsed, cursor.rowcount)
+
+    def current_route(self):
+        handler = self.handler_func() if self.handler_func is not None else None
+        if handler is None:
+            return None, None
+        return handler.route, handler.__class__.__name__
+
+    def record(self, statement, parameters, executemany, elapsed, rowcount):
+        route, handler_class = self.current_route()
+        model_method, call_site = find_call_site(sys._getframe(1))
+
+        stats = self.stats.get(statement)
+        if stats is None and len(self.stats) < self.max_statements:
+            stats = self.stats[statement] = StatementStats()
+        if stats is not None:
+            stats.add(elapsed, rowcount, route, model_method or call_site)
+
+        self.logger.info(json.dumps({
+            "ms": round(elapsed * 1000, 2),
+            "statement": statement,
+            "params": params_shape(parameters, executemany),
+            "rows": rowcount,
+            "route": route,
+            "handler": handler_class,
+            "model_method": model_method,
+            "call_site": call_site,
+        }))
+
+    def top(self, limit=20):
+        """ statements ordered by total time """
+        items = sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)
+        result = []
+        for statement, stats in items[:limit]:
+            data = stats.to_dict()
+            data["statement"] = statement
+            result.append(data)
+        return result
+
+    def reset(self):
+        self.stats = {}
@@ -0,0 +1,99 @@
+# coding: utf-8
+# warning: keep this module free of third party imports,
+# it is installed before anything else is imported
+
+import sys
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+
+class ImportNode(object):
+    __slots__ = ("name", "elapsed", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.children = []
+
+    @property
+    def self_time(self):
+        return self.elapsed - sum(child.elapsed for child in self.children)
+
+
+class ImportProfiler(object):
+    """ ImportProfiler, record the import time of every module newly
+    imported, as a tree of importer -> imported modules.
+
+    Example usage::
+
+        profiler = ImportProfiler()
+        profiler.install()
+
+        import tornado.web
+
+        profiler.uninstall()
+        profiler.report()
+
+    """
+
+    def __init__(self):
+        self.root = ImportNode("<startup>")
+        self.stack = [self.root]
+        self.started = time.time()
+        self._org_import = None
+
+    def install(self):
+        self._org_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._org_import is not None:
+            builtins.__import__ = self._org_import
+            self._org_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        if name in sys.modules:
+            return self._org_import(name, globals, locals, fromlist, level)
+
+        node = ImportNode(name)
+        self.stack[-1].children.append(node)
+        self.stack.append(node)
+        start = time.time()
+        try:
+            return self._org_import(name, globals, locals, fromlist, level)
+        finally:
+            node.elapsed = time.time() - start
+            self.stack.pop()
+
+    def report(self, total=None, min_ms=1.0, stream=None):
+        """ print the import tree, skip subtrees faster than min_ms
+        :param total: seconds to report as time to listen
+        """
+        stream = stream or sys.stderr
+        self.root.elapsed = sum(child.elapsed for child in self.root.children)
+
+        stream.write("%12s %10s  %s\n" % ("cumulative", "self", "module"))
+        self._report_node(self.root, 0, min_ms, stream)
+
+        if total is not None:
+            stream.write("Imports: %.2fms\n" % (self.root.elapsed * 1000))
+            stream.write("Time to listen: %.2fms\n" % (total * 1000))
+
+    def _report_node(self, node, depth, min_ms, stream):
+        stream.write("%10.2fms %8.2fms  %s%s\n" % (node.elapsed * 1000, node.self_time * 1000,
+                                                   "  " * depth, node.name))
+        for child in node.children:
+            if child.elapsed * 1000 >= min_ms:
+                self._report_node(child, depth + 1, min_ms, stream)
+
+
+def profile_requested(argv):
+    for arg in argv[1:]:
+        name, _, value = arg.partition("=")
+        if name in ("--profile-startup", "--profile_startup"):
+            return value.lower() not in ("false", "0")
+    return False
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import time
+
+# layers timed per request
+DB = 0
+REDIS = 1
+RENDER = 2
+LAYER_NAMES = ("db", "redis", "render")
+
+_timings_func = None
+_TimedStrictRedis = None
+
+
+def set_timings_func(func):
+    """ set the function returning RequestTimings of the current request """
+    global _timings_func
+    _timings_func = func
+
+
+def cur_timings():
+    if _timings_func is None:
+        return None
+    return _timings_func()
+
+
+def record(layer, seconds):
+    timings = cur_timings()
+    if timings is not None:
+        timings.add(layer, seconds)
+
+
+def record_saved(round_trips):
+    """ Redis round trips saved by auto pipelining """
+    timings = cur_timings()
+    if timings is not None:
+        timings.redis_saved += round_trips
+
+
+class RequestTimings(object):
+    """ RequestTimings, round trips and seconds spent in each layer of a request """
+    __slots__ = ("counts", "totals", "redis_saved")
+
+    def __init__(self):
+        self.counts = [0] * len(LAYER_NAMES)
+        self.totals = [0.0] * len(LAYER_NAMES)
+        self.redis_saved = 0
+
+    def add(self, layer, seconds):
+        self.counts[layer] += 1
+        self.totals[layer] += seconds
+
+    def server_timing(self, total=None):
+        """ value of Server-Timing header, description is the round trip count """
+        metrics = ["%s;desc=\"%d\";dur=%.2f" % (name, self.counts[i], self.totals[i] * 1000)
+                   for i, name in enumerate(LAYER_NAMES) if self.counts[i]]
+        if self.redis_saved:
+            metrics.append("redis_saved;desc=\"%d\"" % self.redis_saved)
+        if total is not None:
+            metrics.append("total;dur=%.2f" % (total * 1000))
+        return ", ".join(metrics)
+
+    def summary(self):
+        """ text for access log, count/milliseconds per layer """
+        summary = " ".join("%s=%d/%.2fms" % (name, self.counts[i], self.totals[i] * 1000)
+                           for i, name in enumerate(LAYER_NAMES) if self.counts[i])
+        if self.redis_saved:
+            summary += " redis_saved=%d" % self.redis_saved
+        return summary
+
+
+def install_db_timer(engine):
+    """ time cursor executions of a SQLAlchemy engine """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("timing_start", []).append(time.time())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record(DB, time.time() - conn.info["timing_start"].pop())
+
+
+def timed_redis_class():
+    """ StrictRedis subclass timing commands and pipeline executions,
+    redis is imported on first call
+    """
+    global _TimedStrictRedis
+    if _TimedStrictRedis is not None:
+        return _TimedStrictRedis
+
+    import redis
+
+    class TimedStrictRedis(redis.StrictRedis):
+        def execute_command(self, *args, **options):
+            start = time.time()
+            try:
+                return super(TimedStrictRedis, self).execute_command(*args, **options)
+            finally:
+                record(REDIS, time.time() - start)
+
+        def pipeline(self, transaction=True, shard_hint=None):
+            pipe = super(TimedStrictRedis, self).pipeline(transaction, shard_hint)
+            execute = pipe.execute
+
+            def timed_execute(raise_on_error=True):
+                start = time.time()
+                try:
+                    return execute(raise_on_error)
+                finally:
+                    record(REDIS, time.time() - start)
+
+            pipe.execute = timed_execute
+            return pipe
+
+    _TimedStrictRedis = TimedStrictRedis
+    return _TimedStrictRedis
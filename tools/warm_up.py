@@ -0,0 +1,84 @@
+# coding: utf-8
+
+import os
+import time
+
+from .log import app_log
+
+
+def warm_up_db(conn):
+    """ open db_pool_size connections and ping them, they stay in the pool """
+    engine = conn.db_engine
+    pool_size = conn.config.get("db_pool_size", 1)   # removed for sqlite
+    connections = [engine.connect() for _ in range(pool_size)]
+    try:
+        for connection in connections:
+            connection.execute("SELECT 1")
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def warm_up_redis(conn):
+    """ open a connection in the sync Redis pool """
+    conn.redis.ping()
+    return 1
+
+
+def warm_up_clients(conn):
+    """ build mail, AWS, LinkedIn clients and cache proxies """
+    clients = [conn.mail_client, conn.aws_client, conn.linkedin_client, conn.cache]
+
+    aws_config = conn.aws_client.config
+    if not aws_config.debug_local and aws_config.s3_bucket:
+        # open the S3 HTTP pool, read-only: get_bucket creates a missing bucket
+        # noinspection PyBroadException
+        try:
+            conn.aws_client.s3.meta.client.head_bucket(Bucket=aws_config.s3_bucket)
+        except Exception:
+            app_log.warning("S3 bucket %s is not reachable", aws_config.s3_bucket, exc_info=True)
+    return len(clients)
+
+
+def warm_up_user_info(conn, limit, rate, batch=500):
+    """ fill user_info of the most recently active accounts missing in Redis,
+    e.g. after a failover, accounts are the latest of the recent_active set,
+    or the latest joined if it is empty too, logged in ones only. Settings are loaded in one
+    query, keys are written in pipelines of batch at most rate per second,
+    rate 0 doesn't throttle
+    :return: keys written
+    """
+    import models as db
+    cache = conn.cache
+    pks = cache.recent_active(limit)
+    session = db.new_session()
+    try:
+        if not pks:
+            pks = db.Account.latest_joined_pks(limit, session=session)
+        pks = cache.live_sessions(pks)
+        settings = db.Account.get_settings_many(pks, session=session, active_only=True)
+    finally:
+        session.close()
+
+    written = 0
+    start = time.time()
+    for i in range(0, len(pks), batch):
+        items = [(pk, settings[pk]) for pk in pks[i:i + batch] if pk in settings]
+        written += cache.user_info.fill_many(items, ex=cache.user_info.refresh_ex)
+        if rate > 0:
+            time.sleep(max(0.0, float(i + batch) / rate - (time.time() - start)))
+    return written
+
+
+def warm_up_templates(loader, template_root):
+    """ compile every template under template_root """
+    count = 0
+    for dir_path, _, file_names in os.walk(template_root):
+        for file_name in file_names:
+            if not file_name.endswith(".html"):
+                continue
+            name = os.path.relpath(os.path.join(dir_path, file_name), template_root)
+            loader.load(name.replace(os.sep, "/"))
+            count += 1
+    return count
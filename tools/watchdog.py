@@ -0,0 +1,157 @@
+# coding: utf-8
+
+import os
+import sys
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from tornado.web import RequestHandler
+
+from .log import app_log
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# lag histogram upper bounds in seconds, +Inf bucket added after them
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def find_blocking_site(frame):
+    """ find the innermost application frame and the handler running it
+    :return: ("file:line function", handler or None)
+    """
+    site = handler = None
+    while frame is not None:
+        file_name = os.path.abspath(frame.f_code.co_filename)
+        if site is None and file_name.startswith(ROOT):
+            site = "%s:%d %s" % (os.path.relpath(file_name, ROOT),
+                                 frame.f_lineno, frame.f_code.co_name)
+        if handler is None:
+            obj = frame.f_locals.get("self")
+            if isinstance(obj, RequestHandler):
+                handler = obj
+        if site is not None and handler is not None:
+            break
+        frame = frame.f_back
+    return site or "<unknown>", handler
+
+
+class IOLoopWatchdog(object):
+    """ IOLoopWatchdog, measure IOLoop lag continuously and find the
+    callbacks blocking it.
+
+    A heartbeat callback is scheduled every interval seconds, its delay is
+    the IOLoop lag. A monitor thread checks the last heartbeat, when it is
+    older than threshold the IOLoop thread stack is sampled, the blocking
+    call site and the handler running it are counted.
+
+    Example usage::
+
+        watchdog = IOLoopWatchdog(interval=0.05, threshold=0.1)
+        IOLoop.current().add_callback(watchdog.start)
+
+    """
+
+    def __init__(self, interval=0.05, threshold=0.1, max_sites=500):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_sites = max_sites
+
+        self.lag_counts = [0] * (len(LAG_BUCKETS) + 1)
+        self.lag_sum = 0.0
+        self.sites = Counter()      # call site -> blocks
+        self.site_time = Counter()      # call site -> blocked seconds at detection
+        self.site_routes = defaultdict(Counter)     # call site -> route/handler -> blocks
+
+        self._lock = threading.Lock()
+        self._io_loop = None
+        self._thread_ident = None
+        self._expected = None
+        self._last_beat = None
+        self._reported = False
+        self._running = False
+
+    def start(self):
+        """ start on the IOLoop thread """
+        from tornado.ioloop import IOLoop
+
+        self._io_loop = IOLoop.current()
+        self._thread_ident = threading.current_thread().ident
+        self._running = True
+        self._last_beat = time.time()
+        self._schedule()
+
+        monitor = threading.Thread(target=self._monitor, name="ioloop-watchdog")
+        monitor.daemon = True
+        monitor.start()
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self):
+        self._expected = time.time() + self.interval
+        self._io_loop.call_later(self.interval, self._beat)
+
+    def _beat(self):
+        now = time.time()
+        lag = max(now - self._expected, 0.0)
+        self.lag_counts[bisect_left(LAG_BUCKETS, lag)] += 1
+        self.lag_sum += lag
+
+        self._last_beat = now
+        self._reported = False
+        if self._running:
+            self._schedule()
+
+    def _monitor(self):
+        while self._running:
+            time.sleep(self.interval)
+            blocked = time.time() - self._last_beat - self.interval
+            if blocked < self.threshold or self._reported:
+                continue
+
+            self._reported = True     # one sample per blocking callback
+            frame = sys._current_frames().get(self._thread_ident)
+            if frame is not None:
+                self.record_block(frame, blocked)
+
+    def record_block(self, frame, blocked):
+        site, handler = find_blocking_site(frame)
+        if handler is None:
+            route = None
+        else:
+            route = "%s %s" % (getattr(handler, "route", handler.request.path),
+                               handler.__class__.__name__)
+
+        with self._lock:
+            if site in self.sites or len(self.sites) < self.max_sites:
+                self.sites[site] += 1
+                self.site_time[site] += blocked
+                self.site_routes[site][route] += 1
+
+        app_log.warning("IOLoop blocked for more than %.0fms in %s (%s)",
+                        blocked * 1000, site, route)
+
+    def lag_histogram(self):
+        bounds = ["%g" % bound for bound in LAG_BUCKETS] + ["+Inf"]
+        return {"buckets": dict(zip(bounds, self.lag_counts)),
+                "count": sum(self.lag_counts),
+                "sum": self.lag_sum}
+
+    def top_sites(self, limit=20):
+        """ blocking call sites ordered by count """
+        with self._lock:
+            return [{"site": site,
+                     "count": count,
+                     "blocked_ms": round(self.site_time[site] * 1000, 2),
+                     "routes": dict(self.site_routes[site])}
+                    for site, count in self.sites.most_common(limit)]
+
+    def reset(self):
+        with self._lock:
+            self.lag_counts = [0] * (len(LAG_BUCKETS) + 1)
+            self.lag_sum = 0.0
+            self.sites.clear()
+            self.site_time.clear()
+            self.site_routes.clear()
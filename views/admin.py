@@ -0,0 +1,101 @@
+# coding: utf-8
+import hmac
+
+from tornado import gen
+from tornado.escape import utf8
+from tornado.web import HTTPError
+
+from basehandlers import BaseHandler
+
+
+class AdminHandler(BaseHandler):
+    """ AdminHandler, requests must send X-Admin-Token equal to admin_token """
+    @gen.coroutine
+    def prepare(self):
+        yield super(AdminHandler, self).prepare()
+        token = self.config.admin_token
+        if not token or not hmac.compare_digest(utf8(self.get_header("X-Admin-Token", "")),
+                                                utf8(token)):
+            raise HTTPError(403)
+
+    def check_xsrf_cookie(self):
+        """ the admin token is the credential, not a cookie """
+        pass
+
+
+class SlowQueryHandler(AdminHandler):
+    """ slow statements of this worker ordered by total time, DELETE resets """
+    def get(self):
+        if self.application.slow_query_log is None:
+            raise HTTPError(404)
+        limit = int(self.get_argument("limit", 20))
+        self.write({"worker": self.application.worker_id,
+                    "statements": self.application.slow_query_log.top(limit)})
+
+    def delete(self):
+        if self.application.slow_query_log is None:
+            raise HTTPError(404)
+        self.application.slow_query_log.reset()
+
+
+class BlockingHandler(AdminHandler):
+    """ IOLoop lag histogram and top blocking call sites of this worker, DELETE resets """
+    def get(self):
+        if self.application.watchdog is None:
+            raise HTTPError(404)
+        limit = int(self.get_argument("limit", 20))
+        self.write({"worker": self.application.worker_id,
+                    "lag": self.application.watchdog.lag_histogram(),
+                    "sites": self.application.watchdog.top_sites(limit)})
+
+    def delete(self):
+        if self.application.watchdog is None:
+            raise HTTPError(404)
+        self.application.watchdog.reset()
+
+
+class CacheStatsHandler(AdminHandler):
+    """ local cache and page cache hit rates, invalidation lag and Redis
+    round trips saved by auto pipelining of this worker, DELETE clears the page cache
+    """
+    def get(self):
+        conn = self.application.conn
+        page_cache = self.application.page_cache
+        self.write({"worker": self.application.worker_id,
+                    "cache": conn.cache.stats(),
+                    "page_cache": page_cache.stats() if page_cache is not None else None,
+                    "redis_pipeline": (conn.redis_pipelined.stats()
+                                       if self.config.redis_auto_pipeline else None)})
+
+    def delete(self):
+        if self.application.page_cache is not None:
+            self.application.page_cache.clear()
+
+
+class WarmUserInfoHandler(AdminHandler):
+    """ POST fills user_info of recently active accounts, e.g. after a Redis failover """
+    @gen.coroutine
+    def post(self):
+        written = yield self.application.warm_user_info()
+        self.write({"written": written})
+
+
+class MetricsHandler(BaseHandler):
+    """ Prometheus metrics of all workers, enabled by metrics_endpoint """
+    def get(self):
+        if self.application.metrics is None:
+            raise HTTPError(404)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.application.metrics.export())
+
+
+metrics_url_patterns = [
+    (r"/metrics", MetricsHandler),
+]
+
+admin_url_patterns = [
+    (r"/admin/slow_queries", SlowQueryHandler),
+    (r"/admin/blocking", BlockingHandler),
+    (r"/admin/cache", CacheStatsHandler),
+    (r"/admin/warm_user_info", WarmUserInfoHandler),
+]
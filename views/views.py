@@ -1,22 +1,27 @@
 # coding: utf-8
 from basehandlers import BaseHandler
+from tools.page_cache import page_cache_get
 
 
 class IndexHandler(BaseHandler):
+    @page_cache_get(vary=("is_login",))
     def get(self):
         self.render('index.html', is_login=self.is_login())
 
 
 class MentorsHandler(BaseHandler):
+    @page_cache_get(vary=("is_login",))
     def get(self):
         self.render('mentors.html', is_login=self.is_login())
 
 
 class CourseHandler(BaseHandler):
+    @page_cache_get(vary=("is_login",))
     def get(self):
         self.render('course.html', is_login=self.is_login())
 
 
 class AboutHandler(BaseHandler):
+    @page_cache_get(vary=("is_login",))
     def get(self):
         self.render('about.html', is_login=self.is_login())
\ No newline at end of file
@@ -1,32 +1,97 @@
 import os.path
+import sys
+import time
+import signal
+import tempfile
+from tools.startup import ImportProfiler, profile_requested
+
+START_TIME = time.time()
+import_profiler = ImportProfiler() if profile_requested(sys.argv) else None
+if import_profiler is not None:
+    import_profiler.install()
+
 from environment import *   # important to setup syspath
-import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
 import tornado.web
 import tornado.autoreload
 import logging
 import pprint
+from tornado import gen
 import models
 from common.mytypes import MagicDict
-from basehandlers import get_cur_handler
-from settings import settings, options
+from basehandlers import BaseHandler, get_cur_handler, get_cur_timings, get_cur_request_handler
+from settings import settings, options, TEMPLATE_ROOT
 from urls import url_patterns
-from tools.conn import Connections
+from tools.conn import Connections, preload_modules
 from tools.bg_tasks import BackgroundTasks
+from tools.prefork import Supervisor, DrainingHTTPServer
+from tools import warm_up
+from tools import timing
+from tools.log import access_log
+from tools.metrics import RouteMetrics
+from tools.slow_query import SlowQueryLog
+from tools.profiling import RequestProfiler
+from tools.watchdog import IOLoopWatchdog
+from tools.page_cache import PageCache
+from views.admin import metrics_url_patterns, admin_url_patterns
 
 
 class Application(tornado.web.Application):
     def __init__(self):
-        tornado.web.Application.__init__(self, url_patterns, **settings)
+        handlers = list(url_patterns)
+        if options.metrics_endpoint:
+            handlers.extend(metrics_url_patterns)
+        if options.admin_token:
+            handlers.extend(admin_url_patterns)
+        tornado.web.Application.__init__(self, handlers, **settings)
+        self.handler_routes = {}      # handler class -> url pattern
+        for pattern, handler in reversed(handlers):
+            self.handler_routes[handler] = pattern
         self.config = MagicDict(options.as_dict())
         self.conn = Connections(self.config)
         self.bg_tasks = BackgroundTasks(self.config, self.conn)
+        self.worker_id = 0
+        self.inflight = 0     # requests being handled, see BaseHandler
+        self.shutting_down = False
+        self.metrics = None
+        self.init_metrics()
+        self.slow_query_log = None
+        if self.config.slow_query_ms:
+            self.slow_query_log = SlowQueryLog(self.config.slow_query_ms / 1000.0,
+                                               handler_func=get_cur_request_handler,
+                                               log_file=self.config.slow_query_log_file or None)
+        self.profiler = None
+        if self.config.profile_sample_rate or self.config.admin_token:
+            self.profiler = RequestProfiler(
+                self.config.profile_dir or os.path.join(tempfile.gettempdir(), "onecareer_profiles"),
+                sample_rate=self.config.profile_sample_rate,
+                admin_token=self.config.admin_token or None)
+        self.page_cache = None
+        if self.config.page_cache and not self.config.debug:
+            self.page_cache = PageCache(TEMPLATE_ROOT, loader=self.settings["template_loader"],
+                                        max_entries=self.config.page_cache_max_entries)
+        self.watchdog = None
+        if self.config.watchdog_threshold_ms:
+            self.watchdog = IOLoopWatchdog(interval=self.config.watchdog_interval_ms / 1000.0,
+                                           threshold=self.config.watchdog_threshold_ms / 1000.0)
         self.init_db()
 
-    def init_db(self):
+        if self.warm_up_enabled:
+            # prefork workers open their own connections after fork
+            self.warm_up(connections=self.config.processes == 1)
+
+    def bind_engine(self):
         models.bind_engine(self.conn.db_engine)
+        if self.slow_query_log is not None:
+            self.slow_query_log.install(self.conn.db_engine)
+
+    def init_db(self):
+        self.bind_engine()
         models.set_scope_func(get_cur_handler)
+        models.set_cache_invalidator(self.apply_cache_changes)
+        timing.set_timings_func(get_cur_timings)
 
         if not self.config["debug"]:
             return
@@ -43,13 +108,174 @@ class Application(tornado.web.Application):
         user = models.init_debug_data()
         self.conn.redis.flushall()
 
+    def apply_cache_changes(self, changes):
+        """ refresh cache keys of rows changed by a commit """
+        self.conn.cache.apply_changes(changes)
 
-if __name__ == '__main__':
-    tornado.options.parse_command_line()
+    @property
+    def warm_up_enabled(self):
+        if self.config.warm_up is None:
+            return not self.config.debug
+        return self.config.warm_up
+
+    def warm_up(self, connections=True, templates=True):
+        """ open connections, build clients and compile templates,
+        so the first requests don't pay for them
+        :return: list of (step name, seconds)
+        """
+        steps = []
+        if connections:
+            steps.append(("db", lambda: warm_up.warm_up_db(self.conn)))
+            steps.append(("redis", lambda: warm_up.warm_up_redis(self.conn)))
+            steps.append(("clients", lambda: warm_up.warm_up_clients(self.conn)))
+        if templates:
+            steps.append(("templates", lambda: warm_up.warm_up_templates(
+                self.settings["template_loader"], TEMPLATE_ROOT)))
+
+        timings = []
+        for name, step in steps:
+            start = time.time()
+            count = step()
+            elapsed = time.time() - start
+            timings.append((name, elapsed))
+            logging.info("Warm up %s: %d in %.2fms" % (name, count, elapsed * 1000))
+        return timings
+
+    def warm_user_info(self):
+        """ fill user_info of recently active accounts in background
+        :return: Future of keys written
+        """
+        return self.bg_tasks.warm_user_info(self.config.warm_user_info_limit,
+                                            self.config.warm_user_info_rate)
+
+    def init_metrics(self):
+        if not self.config.metrics:
+            return
+
+        store_dir = self.config.metrics_dir or os.path.join(
+            tempfile.gettempdir(), "onecareer_metrics_%s" % self.config.port)
+        self.metrics = RouteMetrics(url_patterns + metrics_url_patterns + admin_url_patterns,
+                                    store_dir)
+        self.metrics.clear()
+        self.metrics.open(self.worker_id)
+
+    def log_request(self, handler):
+        """ tornado access log with db, redis and render timings """
+        if "log_function" in self.settings or not isinstance(handler, BaseHandler):
+            super(Application, self).log_request(handler)
+        else:
+            if handler.get_status() < 400:
+                log_method = access_log.info
+            elif handler.get_status() < 500:
+                log_method = access_log.warning
+            else:
+                log_method = access_log.error
+            log_method("%d %s %.2fms %s", handler.get_status(), handler._request_summary(),
+                       1000.0 * handler.request.request_time(), handler.timings.summary())
+
+        if self.metrics is not None:
+            if isinstance(handler, BaseHandler):
+                elapsed = handler.request_time()
+            else:
+                elapsed = handler.request.request_time()
+            self.metrics.observe(handler.__class__, handler.get_status(), elapsed)
+
+    def before_fork(self):
+        """ close connections opened by the parent process """
+        models.remove_session()
+        self.conn.close()
+        preload_modules()
+
+    def after_fork(self, worker_id):
+        """ re-create connections in a forked worker """
+        self.worker_id = worker_id
+        self.conn.reset()
+        if self.metrics is not None:
+            self.metrics.open(worker_id)
+        self.bg_tasks.after_fork()
+        if self.slow_query_log is not None and self.config.slow_query_log_file:
+            self.slow_query_log.open_log("%s.%d" % (self.config.slow_query_log_file, worker_id))
+        self.bind_engine()
+
+        if self.warm_up_enabled:
+            self.warm_up(templates=False)    # templates compiled before fork
+
+    def install_signal_handlers(self, http_server, prefork=False):
+        """ SIGTERM drains and exits, so does SIGHUP in single process mode,
+        prefork workers ignore SIGHUP, the supervisor restarts them one by one
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        def handle_stop(signum, frame):
+            _ = frame
+            logging.warning("Received signal %d, shutting down" % signum)
+            io_loop.add_callback_from_signal(self.shutdown, http_server)
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        if prefork:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        else:
+            signal.signal(signal.SIGHUP, handle_stop)
+
+    @gen.coroutine
+    def shutdown(self, http_server):
+        """ stop accepting connections, close idle keep-alive ones, wait for
+        in-flight requests and background tasks up to shutdown_timeout,
+        then stop the IOLoop
+        """
+        if self.shutting_down:
+            return
+        self.shutting_down = True
+
+        http_server.drain()
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + self.config.shutdown_timeout
+        while self.inflight or self.bg_tasks.pending:
+            if io_loop.time() >= deadline:
+                logging.warning("Shutdown timeout, %d requests and %d background tasks dropped" %
+                                (self.inflight, len(self.bg_tasks.pending)))
+                break
+            yield gen.sleep(0.05)
+
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        models.remove_session()
+        self.conn.close()
+        io_loop.stop()
+
+
+def main():
     app = Application()
-    http_server = tornado.httpserver.HTTPServer(app)
-    http_server.listen(options.port, options.host)
-    logging.critical("Tornado server started on %s:%s" %
-                     (options.host, options.port))
+    sockets = tornado.netutil.bind_sockets(options.port, options.host,
+                                           reuse_port=options.reuse_port)
+
+    prefork = options.processes != 1
+    if prefork:
+        if options.debug:
+            raise RuntimeError("Multi-process mode is not supported in debug mode")
+
+        app.before_fork()
+        supervisor = Supervisor(num_processes=options.processes,
+                                max_restarts=options.max_restarts)
+        app.after_fork(supervisor.start())
+
+    http_server = DrainingHTTPServer(app)
+    http_server.add_sockets(sockets)
+    app.install_signal_handlers(http_server, prefork=prefork)
+    if import_profiler is not None:
+        import_profiler.uninstall()
+        import_profiler.report(total=time.time() - START_TIME)
+    logging.critical("Tornado server started on %s:%s (worker %s, pid %s)" %
+                     (options.host, options.port, app.worker_id, os.getpid()))
     pprint.pprint(url_patterns)
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    if app.watchdog is not None:
+        tornado.ioloop.IOLoop.instance().add_callback(app.watchdog.start)
+    if options.warm_user_info_limit and not options.debug and app.worker_id == 0:
+        tornado.ioloop.IOLoop.instance().add_callback(app.warm_user_info)
+    tornado.ioloop.IOLoop.instance().start()
+
+
+if __name__ == '__main__':
+    tornado.options.parse_command_line()
+    main()